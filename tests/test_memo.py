@@ -1,5 +1,6 @@
 import datetime
 from json import dumps, loads
+from StringIO import StringIO
 from nose.tools import assert_raises
 
 from xodb.elements import (
@@ -13,10 +14,11 @@ from xodb.elements import (
     Schema,
     String,
     Text,
+    _index_step,
     )
 
-from xodb.memo import Memo
-from xodb.exc import InvalidTermError
+from xodb.memo import Memo, MemoReader, MemoWriter
+from xodb.exc import InvalidTermError, MemoFormatError
 
 class Object(object):
 
@@ -322,6 +324,16 @@ def test_location():
                              ])
 
 
+def test_index_step():
+    fields = dict((f.name, f) for f in Texter.field_schema)
+    step = _index_step(fields['t8'])
+    assert step.handler == '_handle_text'
+    assert step.wdf_inc == 2
+    assert not step.boolean
+    assert _index_step(fields['t8']) is step
+    assert _index_step(fields['language']).handler == '_handle_string'
+
+
 def test_long_term():
     m = Memo()
     assert_raises(InvalidTermError, m.add_term, " " * 250)
@@ -344,3 +356,32 @@ def test_ignore_invalid():
     s.update_by_object(f)
     d = s.__xodb_memo__.dict
     assert not d['terms']
+
+
+def test_memo_bytes():
+    s = Texter.from_defaults()
+    s.update_by_object(Object(t1=u'one', t4=u'four', t8=u'many thanks'))
+    memo = s.__xodb_memo__
+    memo.add_post('foo', 3, 2)
+    memo.add_value(u'neg', -42, 'integer')
+    data = memo.to_bytes()
+    assert data.startswith('XM')
+    assert Memo.from_bytes(data).dict == memo.dict
+    assert_raises(MemoFormatError, Memo.from_bytes, data[:-1])
+    assert_raises(MemoFormatError, Memo.from_bytes, data + 'x')
+    assert_raises(MemoFormatError, Memo.from_bytes, 'nope')
+
+    memo.set_key(u'k\xe9y')
+    assert Memo.from_bytes(memo.to_bytes()).key == u'k\xe9y'
+
+
+def test_memo_stream():
+    memos = []
+    for i in range(3):
+        s = Inter.from_defaults()
+        s.update_by_object(Object(i1=i, i5=i * 10))
+        memos.append(s.__xodb_memo__)
+    f = StringIO()
+    MemoWriter(f).write_all(memos)
+    f.seek(0)
+    assert [m.dict for m in MemoReader(f)] == [m.dict for m in memos]
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import shutil
+import xapian
 import xodb
 from datetime import datetime, date
+from nose.tools import assert_raises
 
 from xodb import (
     Array,
@@ -367,6 +369,13 @@ def test_suggest():
             set([u'department:housing']))
 
 
+def test_suggest_rset_limit():
+    everything = set(db.suggest('bob', rset_limit=0))
+    assert set(db.suggest('bob')) == everything
+    top = set(db.suggest('bob', rset_limit=1))
+    assert top and top <= everything
+
+
 def test_facet():
     assert (db.facet('name:housing') ==
             {u'facet:employees': 1, u'facet:name': 1})
@@ -430,3 +439,106 @@ def test_metadata():
     assert l[0]._xodb_rank == 0
     assert l[1]._xodb_rank == 1
     assert l[0]._xodb_weight > l[1]._xodb_weight
+
+
+def test_record_view():
+    r, = db.query('salary:4500', view=True)
+    assert isinstance(r, xodb.RecordView)
+    assert r._xodb_schema is None
+    assert r.name == u'joe'
+    assert r.salary == 4500
+    assert r.hired == date(1999, 9, 9)
+    assert r.nothing is None
+    assert r._xodb_schema is None
+    assert r.properties == dict(status='annoying', shoe_size=3)
+    assert r.location == (7.0625, -95.677068)
+    assert r.load()['last'].value == u'bob'
+
+
+def test_fields():
+    rows = list(db.query('bob', order='rank', fields=['name', 'rank', 'last']))
+    assert rows == [dict(name=u'joe', rank=2, last=u'bob'),
+                    dict(name=u'jane', rank=100, last=u'bob')]
+    covered, uncovered = db._projection(['name', 'rank', 'last'])
+    assert [c[0] for c in covered] == ['name', 'rank']
+    assert uncovered == ['last']
+
+    search = xodb.Search(db, 'bob', order='rank')
+    assert list(search.select('name', 'salary')) == [
+        dict(name=u'joe', salary=4500), dict(name=u'jane', salary=5600)]
+    assert list(search.select('name', 'location')) == [
+        dict(name=u'joe', location=(7.0625, -95.677068)),
+        dict(name=u'jane', location=(51.500152, -0.126236))]
+    assert db._projection(['location']) == ([], ['location'])
+
+
+def test_facets():
+    facets = db.facets('name:jane OR name:joe', ['facet', 'name'])
+    assert facets['facet'] == db.facet('name:jane OR name:joe')
+    assert facets['name'] == {u'name:jane': 1, u'name:joe': 2}
+
+    facets = db.facets('name:jane OR name:joe', ['name'],
+                       include_query_terms=False)
+    assert facets == {'name': {}}
+
+    assert db.facet('name:jane OR name:joe', limit=1) == {u'facet:name': 3}
+    assert (db.facet('name:jane OR name:joe', estimate=False) ==
+            {u'facet:department': 2,
+             u'facet:name': 3,
+             u'facet:employees': 1})
+
+
+def test_value_facets():
+    facets = db.facets('name:jane OR name:joe', (),
+                       values=['rank', ('rank', 50), ('hired', 'year')])
+    assert facets['rank'] == {'rank:2..2': 1, 'rank:100..100': 1}
+    assert facets[('rank', 50)].items() == [('rank:0..49', 1),
+                                            ('rank:100..149', 1)]
+    assert facets[('hired', 'year')].items() == [
+        ('hired:19990000..19999999', 1),
+        ('hired:20000000..20009999', 1)]
+    for facet in facets[('rank', 50)]:
+        assert db.count(facet) == 1
+    for facet in facets[('hired', 'year')]:
+        assert db.count(facet) == 1
+
+    facets = db.facets('name:jane OR name:joe', (), values=['job', 'name'])
+    assert facets['job'] == {u'job:"cake inspector"': 1,
+                             u'job:"steak inspector"': 1}
+    assert facets['name'] == {u'name:joe': 1, u'name:jane': 1}
+    for facet in facets['job']:
+        assert db.count(facet) == 1
+    assert_raises(ValueError, db.facets, 'name:joe', ['name'],
+                  values=['name'])
+    assert_raises(ValueError, db.facets, 'name:joe', (), values=['nope'])
+    assert_raises(ValueError, db.facets, 'name:joe', (),
+                  values=[('hired', 'week')])
+
+
+def test_global_facets():
+    everything = xapian.Query('')
+    assert (db.facets('', ['facet', 'name']) ==
+            db.facets(everything, ['facet', 'name']))
+    assert db.facets('', ['name'], limit=1) == {'name': {u'name:joe': 2}}
+    assert (db.expand('', ['facet', ('name', 1)]) ==
+            db.expand(everything, ['facet', ('name', 1)]))
+    # cached counts are copies
+    db.expand('', ['facet']).clear()
+    assert db.expand('', ['facet']) == db.expand(everything, ['facet'])
+
+    values = ['rank', ('hired', 'year')]
+    assert (db.facets('', ['name'], values=values) ==
+            db.facets(everything, ['name'], values=values))
+    db.facets('', (), values=values)['rank'].clear()
+    assert (db.facets('', (), values=values) ==
+            db.facets(everything, (), values=values))
+
+
+def test_expand():
+    r = db.expand('name:jane OR name:joe', ['facet', ('name', 1)])
+    assert r.keys() == [u'facet:name', u'facet:department',
+                        u'facet:employees']
+    assert r[u'facet:name'] == (3, {u'name:joe': 2})
+    assert r[u'facet:department'][0] == 2
+    assert len(r[u'facet:department'][1]) == 1
+    assert r[u'facet:employees'] == (1, {u'name:joe': 1})
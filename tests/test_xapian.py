@@ -3,12 +3,23 @@ import datetime
 import xodb
 import tempfile
 import xapian
-from xodb import MultipleValueRangeProcessor
-from xodb.exc import PrefixError
+from xodb import MultipleValueRangeProcessor, SharedValueAllocator
+from xodb.exc import PrefixError, UniqueKeyRequired
 
 from nose.tools import assert_raises
 
 
+class PoolSchema(xodb.Schema):
+    language = 'en'
+    x = xodb.Integer.named('x')
+
+
+class PoolObject(object):
+
+    def __init__(self, x):
+        self.x = x
+
+
 class _TestDatabase(object):
 
     db_factory = None
@@ -148,6 +159,259 @@ class _TestDatabase(object):
             del db[2]
         assert writer.count() == 0
 
+    def test_add_stream(self):
+        F = PoolObject
+        self.db.map(PoolObject, PoolSchema)
+        seen = []
+        added = self.db.add_stream((F(i) for i in xrange(25)),
+                                   batch_size=10,
+                                   progress=lambda n, t: seen.append(n))
+        assert added == 25
+        assert seen == [10, 20, 25]
+        assert self.db.count() == 25
+        assert self.db.count('x:7') == 1
+
+        added = self.db.add_stream((F(i) for i in xrange(25, 30)),
+                                   batch_size=2, commit_every=3)
+        assert added == 5
+        assert self.db.count() == 30
+
+    def test_replace_if_changed(self):
+        F = PoolObject
+        db = self.db
+        db.map(PoolObject, PoolSchema)
+        assert db.replace(F(1), 1) is not None
+        assert db.fingerprint(1) is None
+        assert db.replace(F(1), 1, if_changed=True) is not None
+        assert db.fingerprint(1) == db.to_memo(F(1)).fingerprint()
+        assert db.replace(F(1), 1, if_changed=True) is None
+        assert db.replace(F(2), 1, if_changed=True) is not None
+        assert db.count('x:2') == 1
+
+        written, skipped = db.sync_stream([(1, F(2)), (2, F(3))])
+        assert (written, skipped) == (1, 1)
+        assert db.count() == 2
+        assert db.count('x:3') == 1
+
+    def test_upsert(self):
+
+        class FS(xodb.Schema):
+            language = 'en'
+            unique_key = 'uid'
+            uid = xodb.String.named('uid')
+            x = xodb.Integer.named('x')
+
+        class F(object):
+            def __init__(self, uid, x):
+                self.uid = uid
+                self.x = x
+
+        db = self.db
+        db.map(F, FS)
+        docid = db.upsert(F('a', 1))
+        assert db.upsert(F('a', 2)) == docid
+        assert db.count() == 1
+        assert db.count('x:2') == 1
+
+        assert db.upsert_many(F(u, 3) for u in 'abc') == 3
+        assert db.count() == 3
+        assert db.count('x:3') == 3
+
+        db.delete_by_key('b')
+        assert db.count() == 2
+        assert db.backend.get_termfreq(db.key_term('b')) == 0
+
+        db.map(PoolObject, PoolSchema)
+        assert_raises(UniqueKeyRequired, db.upsert, PoolObject(1))
+
+        class KS(xodb.Schema):
+            unique_key = 'uid'
+            uid = xodb.String.using(optional=True, default=u'none')
+
+        class K(object):
+            uid = None
+
+        db.map(K, KS)
+        db.add(K())
+        assert_raises(UniqueKeyRequired, db.upsert, K())
+
+    def test_schema_registry(self):
+
+        class FS(xodb.Schema):
+            language = 'en'
+            x = xodb.Integer.named('x')
+
+        class F(object):
+            x = 7
+
+        # FS is local, so it can only be found through the registry
+        self.db.map(F, FS)
+        self.db.add(F())
+        assert [r.x for r in self.db.query('')] == [7]
+
+    def test_value_fast_path(self):
+
+        class FS(xodb.Schema):
+            language = 'en'
+            x = xodb.Integer.named('x')
+            n = xodb.Integer.using(sortable=True)
+            flag = xodb.elements.Boolean.using(sortable=True)
+            born = xodb.Date.using(sortable=True)
+            seen = xodb.DateTime.using(sortable=True)
+            where = xodb.Location.using(sortable=True)
+
+        class F(object):
+            x = 1
+            n = 7
+            flag = True
+            born = datetime.date(1999, 9, 9)
+            seen = datetime.datetime(2010, 10, 10, 10, 10)
+            where = (7.0625, -95.677068)
+
+        self.db.map(F, FS)
+        self.db.add(F())
+        r, = self.db.query('x:1')
+        assert r.flag is True
+        assert r.born == datetime.date(1999, 9, 9)
+        assert r.seen == datetime.datetime(2010, 10, 10, 10, 10)
+        assert r.n == 7
+        assert not r._loaded
+        # geoprints are lossy, locations come from the stored data
+        assert r.where == (7.0625, -95.677068)
+
+        # false values leave the slot empty, they are not None
+        zero = F()
+        zero.x, zero.n = 2, 0
+        self.db.add(zero)
+        r, = self.db.query('x:2')
+        assert r.n == 0
+        row, = self.db.query('x:2', fields=['n'])
+        assert row == dict(n=0)
+
+    def test_custom_value_format(self):
+
+        class FS(xodb.Schema):
+            language = 'en'
+            x = xodb.Integer.named('x')
+            born = xodb.Date.using(sortable=True, value_format='%Y%d%m')
+            where = xodb.Location.using(sortable=True, radians=True)
+
+        class F(object):
+            x = 1
+            born = datetime.date(1999, 2, 1)
+            where = (0.5, -1.5)
+
+        self.db.map(F, FS)
+        self.db.add(F())
+        assert self.db.custom_values == set(['born', 'where'])
+        r, = self.db.query('x:1')
+        assert r.born == datetime.date(1999, 2, 1)
+        assert r.where == (0.5, -1.5)
+        row, = self.db.query('x:1', fields=['born'])
+        assert row == dict(born=datetime.date(1999, 2, 1))
+
+    def test_query_pages(self):
+        db = self.db
+        db.map(PoolObject, PoolSchema)
+        db.add(*[PoolObject(i) for i in xrange(10)])
+        db.query_page_sizes = (2, 3)
+        sizes = []
+        build_mset = db._build_mset
+
+        def _build_mset(enq, offset, limit, *args, **kw):
+            sizes.append((offset, limit))
+            return build_mset(enq, offset, limit, *args, **kw)
+
+        db._build_mset = _build_mset
+        results = db.query('')
+        assert results.next().x == 0
+        assert sizes == [(0, 2)]
+        assert [r.x for r in results] == range(1, 10)
+        assert sizes == [(0, 2), (2, 3), (5, 12)]
+
+        del sizes[:]
+        db.query_page_sizes = (1,)
+        db.query_page_growth = 2
+        assert len(list(db.query(''))) == 10
+        assert sizes == [(0, 1), (1, 2), (3, 4), (7, 8)]
+
+        del sizes[:]
+        assert len(list(db.query('', limit=4))) == 4
+        assert sizes == [(0, 4)]
+
+    def test_page(self):
+
+        class FS(xodb.Schema):
+            language = 'en'
+            x = xodb.Integer.using(sortable=True)
+
+        class F(object):
+            def __init__(self, x):
+                self.x = x
+
+        db = self.db
+        db.map(F, FS)
+        db.add(*[F(i / 4) for i in xrange(11)])
+        for reverse in (False, True):
+            ids = []
+            records, cursor = db.page('', 'x', limit=3, reverse=reverse)
+            while cursor:
+                ids.extend(r._id for r in records)
+                assert len(records) == 3
+                records, cursor = db.page('', 'x', limit=3, cursor=cursor,
+                                          reverse=reverse)
+            ids.extend(r._id for r in records)
+            expected = [r._id for r in db.query('', order='x',
+                                                reverse=reverse)]
+            assert ids == expected
+            assert len(ids) == 11
+
+        assert_raises(ValueError, db.page, '', 'x', cursor='!!')
+
+    def test_parser_pool(self):
+        db = self.db
+        with db.query_parser('en') as qp1:
+            with db.query_parser('en') as qp2:
+                assert qp1 is not qp2
+        assert len(db.parsers_by_language['en']) == 2
+        with db.query_parser('en') as qp3:
+            assert qp3 in (qp1, qp2)
+
+        db.check_prefix('foo')
+        with db.query_parser('en') as qp4:
+            assert [t for t in qp4.parse_query('foo:bar')] == ['XFOO:bar']
+            db.check_prefix('baz')
+        # qp4 was checked out when baz was added, so it is dropped
+        assert len(db.parsers_by_language['en']) == 1
+
+    def test_add_parallel(self):
+        self.db.map(PoolObject, PoolSchema)
+        added = self.db.add_parallel((PoolObject(i) for i in xrange(50)),
+                                     processes=2, chunksize=3, batch_size=20)
+        assert added == 50
+        assert self.db.count() == 50
+        assert [r.x for r in self.db.query('')] == range(50)
+
+    def test_register_schema(self):
+
+        class FS(xodb.Schema):
+            name = xodb.String.using(sortable=True, facet=True)
+            firstName = xodb.String
+            body = xodb.Text
+            born = xodb.Date.using(sortable=True)
+            tags = xodb.List.of(xodb.String)
+
+        class F(object):
+            pass
+
+        self.db.map(F, FS)
+        assert (set(self.db.boolean_prefixes) ==
+                set(['name', 'firstname', 'born', 'facet']))
+        assert set(self.db.relevance_prefixes) == set(['body'])
+        assert (set(self.db.value_sorts.items()) ==
+                set([('name', 'string'), ('born', 'date')]))
+        assert self.db.value_count == 2
+
     def test_stored_values(self):
         db = self.db
         assert db.value_count == 0
@@ -180,6 +444,80 @@ class _TestDatabase(object):
 class TestXapianFile(_TestDatabase):
     db_factory = staticmethod(xodb.temp)
 
+    def test_unbuffered_metadata(self):
+        db = self.db
+        db.check_prefix('foo')
+        db.add_value('bar', 'string')
+        assert db.relevance_prefixes['foo'] == 'XFOO:'
+        assert db.values['bar'] == 1
+        assert db.value_count == 1
+        # registrations reach the backend before any flush, so an
+        # automatic flush can not commit documents without them
+        assert db.backend.get_metadata('_XODB_RP_foo') == 'XFOO:'
+        assert db.backend.get_metadata('_XODB_VALUE_bar') == '1'
+        assert db.backend.get_metadata('_XODB_VALUESORT_bar') == 'string'
+        assert db.backend.get_metadata('_XODB_COUNT_') == '1'
+
+    def test_metadata_generation(self):
+        db = self.db
+        reader = xodb.open(db.db_path, writable=False)
+        db.check_prefix('foo')
+        db.flush()
+        assert db.backend.get_metadata('_XODB_GENERATION_') == '1'
+        assert not db.is_metadata_changed
+        assert reader.is_metadata_changed
+        reader.reopen()
+        assert not reader.is_metadata_changed
+        assert reader.relevance_prefixes['foo'] == 'XFOO:'
+        db.add_value('bar')
+        db.flush()
+        assert db.backend.get_metadata('_XODB_GENERATION_') == '2'
+        reader.reopen()
+        assert reader.values['bar'] == 1
+
+    def test_incremental_refresh(self):
+        db = self.db
+        db.check_prefix('foo')
+        db.flush()
+        reader = xodb.open(db.db_path, writable=False)
+        reader.querify('foo:a')
+        reader.querify('bar:b')
+        (epoch, qp), = reader.parsers_by_language[None]
+
+        db.check_prefix('bar')
+        db.add_value('n', 'integer')
+        db.flush()
+        reader.reopen()
+        assert reader.parsers_by_language[None][0][1] is qp
+        cached = [key[0] for key in reader.query_cache]
+        assert cached == ['foo:a']
+        assert [t for t in reader.querify('bar:b')] == ['XBAR:b']
+        assert str(reader.querify('n:1..2')).startswith(
+            'Xapian::Query(VALUE_RANGE 1 ')
+
+        # queries are cached as written, but parsed lowercased
+        reader.querify('BAZ:c')
+        db.check_prefix('baz')
+        db.flush()
+        reader.reopen()
+        assert [key[0] for key in reader.query_cache
+                if key[0] == 'BAZ:c'] == []
+
+        # a boolean prefix over a relevance one rebuilds the parsers
+        db.add_boolean_prefix('foo', 'XFOO:')
+        db.flush()
+        reader.reopen()
+        assert None not in reader.parsers_by_language
+        assert [t for t in reader.querify('foo:d')] == ['XFOO:d']
+
+        # a key rewritten with a new value makes readers reload all
+        reader.querify('bar:e')
+        db.add_prefix('bar', 'XOTHER:')
+        db.flush()
+        reader.reopen()
+        assert reader.relevance_prefixes['bar'] == 'XOTHER:'
+        assert [t for t in reader.querify('bar:e')] == ['XOTHER:e']
+
 
 class TestXapianInMem(_TestDatabase):
     db_factory = staticmethod(xodb.inmemory)
@@ -208,3 +546,36 @@ def test_value_range_processor():
     assert str(query) == 'Xapian::Query(VALUE_RANGE 2 3 4)'
 
     assert_raises(xapian.QueryParserError, qp.parse_query, 'baz:abc..def')
+
+
+def test_shared_value_allocator():
+    allocator = SharedValueAllocator()
+    db1 = xodb.open(tempfile.mkdtemp(), value_allocator=allocator)
+    db2 = xodb.open(tempfile.mkdtemp(), value_allocator=allocator)
+    assert db1.add_value('foo') == 1
+    assert db2.add_value('bar') == 2
+    assert db2.add_value('foo') == 1
+    assert db1.value_count == db2.value_count == 2
+    for db in (db1, db2):
+        db.close()
+        shutil.rmtree(db.db_path)
+
+
+def test_reopen_policy():
+    writer = xodb.temp()
+    writer.map(PoolObject, PoolSchema)
+    path = writer.db_path
+    never = xodb.open(path, writable=False, reopen_policy='never')
+    revision = xodb.open(path, writable=False, reopen_policy='revision')
+    assert_raises(ValueError, xodb.open, path, writable=False,
+                  reopen_policy='sometimes')
+
+    writer.add(PoolObject(1))
+    writer.flush()
+    assert len(revision) == 1
+    assert len(never) == 0
+    never.refresh()
+    assert len(never) == 1
+    assert never.count('x:1') == 1
+    writer.close()
+    shutil.rmtree(path)
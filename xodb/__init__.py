@@ -10,6 +10,9 @@ from . database import (
     JSONDatabase,
     LanguageDecider,
     MultipleValueRangeProcessor,
+    RecordView,
+    SharedValueAllocator,
+    ValueAllocator,
     )
 
 from . elements import (
@@ -41,10 +44,13 @@ __all__ = [
     'Location',
     'MultipleValueRangeProcessor',
     'NumericRange',
+    'RecordView',
     'Schema',
     'Search',
+    'SharedValueAllocator',
     'String',
     'Text',
+    'ValueAllocator',
     'geoprint',
     'inmemory',
     'open',
@@ -57,7 +63,9 @@ def open(path_or_db,
          overwrite=False,
          spelling=True,
          replicated=False,
-         inmem=False):
+         inmem=False,
+         value_allocator=None,
+         reopen_policy='always'):
     """Return an xodb database with the given path or xapian database object.
 
     :param path_or_db: A path to a database file or a pre-existing
@@ -70,13 +78,21 @@ def open(path_or_db,
 
     :param spelling: If True, write spelling correction data to the
     database.
+
+    :param value_allocator: Optional ValueAllocator used to allocate
+    value slots.
+
+    :param reopen_policy: When read methods reopen the database, see
+    `Database`.
     """
     return Database(path_or_db,
                     writable=writable,
                     overwrite=overwrite,
                     spelling=spelling,
                     replicated=replicated,
-                    inmem=inmem)
+                    inmem=inmem,
+                    value_allocator=value_allocator,
+                    reopen_policy=reopen_policy)
 
 
 def temp(spelling=True):
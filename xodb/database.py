@@ -1,8 +1,15 @@
+import os
 import time
+import base64
 
 import string
 import logging
+import threading
+import multiprocessing
+from copy import deepcopy
 from functools import wraps
+from itertools import islice, chain
+from datetime import datetime
 from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 
@@ -16,13 +23,15 @@ from json import loads
 from xapian import Query, QueryParser, DocNotFoundError
 
 from . import snowball
-from .elements import Schema
-from .exc import ValidationError, PrefixError
+from .elements import Schema, Date, DateTime
+from .memo import Memo
+from .exc import ValidationError, PrefixError, UniqueKeyRequired
 from .tools import LRUDict, lazy_property
 
 
 RETRY_LIMIT = 5
 RETRY_BACKOFF_FACTOR = 0.2
+SCHEMA_REGISTRY_LIMIT = 1024
 
 logger = logging.getLogger(__name__)
 
@@ -48,11 +57,78 @@ def defaults(head, limit=0, mlimit=0, klimit=1.0, kmlimit=1.0):
     return (head, limit, mlimit, klimit, kmlimit)
 
 
+# schemas mapped by any database, never evicted, since local schemas
+# can not be found by importing them
+_schema_registry = {}
+# schemas found by importing their module, bounded
+_resolved_schemas = {}
+_resolved_lock = threading.Lock()
+
+
+def _register_schema(schema):
+    _schema_registry[_schema_name(schema)] = schema
+
+
 def _lookup_schema(name):
-    modname, expr = name.rsplit('.', 1)
-    local_name = modname.split('.')[-1]
-    mod = __import__(modname, {}, {}, local_name)
-    return eval(expr, mod.__dict__)
+    schema = _schema_registry.get(name) or _resolved_schemas.get(name)
+    if schema is None:
+        modname, expr = name.rsplit('.', 1)
+        local_name = modname.split('.')[-1]
+        mod = __import__(modname, {}, {}, local_name)
+        schema = eval(expr, mod.__dict__)
+        with _resolved_lock:
+            if len(_resolved_schemas) >= SCHEMA_REGISTRY_LIMIT:
+                _resolved_schemas.popitem()
+            _resolved_schemas[name] = schema
+    return schema
+
+
+def _build_schema(schema_type, obj, validate=True, db=None):
+    schema = schema_type.from_defaults()
+    schema.__xodb_db__ = db
+    schema.update_by_object(obj)
+
+    if validate and not schema.validate():
+        invalid = []
+        for child in schema.all_children:
+            if not child.valid:
+                invalid.append(child)
+        raise ValidationError("Elements of %s did not validate %s:" %
+                              (schema.__class__.__name__,
+                               list((c.name, c.value)
+                                    for c in invalid)))
+    return schema
+
+
+def _memo_worker(args):
+    """Pool worker that turns a (schema_type, obj, validate) tuple
+    into a memo."""
+    schema_type, obj, validate = args
+    return _build_schema(schema_type, obj, validate).__xodb_memo__
+
+
+def _imap_windowed(pool, func, iterable, chunksize, window):
+    """Like pool.imap, but only pulls *window* items at a time out
+    of *iterable*, keeping at most two windows in flight.  Results are
+    yielded in input order."""
+    iterable = iter(iterable)
+    pending = None
+    while True:
+        chunk = list(islice(iterable, window))
+        results = pool.imap(func, chunk, chunksize) if chunk else None
+        if pending is not None:
+            for result in pending:
+                yield result
+        if results is None:
+            break
+        pending = results
+
+
+def _grow(size, factor):
+    """Generate sizes growing geometrically from *size*."""
+    while True:
+        size *= factor
+        yield size
 
 
 def _prefix(name):
@@ -64,6 +140,52 @@ def to_term(value, prefix=None):
     return _prefix(prefix) + value if prefix else value
 
 
+def _decode_string(value):
+    return value.decode('utf-8')
+
+
+def _decode_integer(value):
+    return int(xapian.sortable_unserialise(value))
+
+
+def _decode_boolean(value):
+    return value == 'true'
+
+
+def _decode_date(value):
+    return datetime.strptime(value, Date.value_format).date()
+
+
+def _decode_datetime(value):
+    return datetime.strptime(value, DateTime.value_format)
+
+
+_value_decoders = {
+    'integer': _decode_integer,
+    'string': _decode_string,
+    'boolean': _decode_boolean,
+    'date': _decode_date,
+    'datetime': _decode_datetime,
+    }
+# locations are stored as geoprints, which only decode to the center
+# of their cell, so they are always read from the stored data
+
+
+def _decode_value(sort, value):
+    """Turn the raw contents of a value slot back into a python value,
+    using the decoder for the value's sort.
+
+    Values of elements with a custom value_format are listed in
+    `Database.custom_values` and must not be decoded here.  Raises
+    ValueError if the value is not in the default format for its sort,
+    or the slot is empty: handlers do not write false values like 0 or
+    '', so an empty slot does not tell them from a missing value.
+    """
+    if not value:
+        raise ValueError("Empty value slot")
+    return _value_decoders[sort](value)
+
+
 class Record(object):
     """Nice attribute-accessable record for a search result."""
 
@@ -79,34 +201,25 @@ class Record(object):
 
     @lazy_property
     def _xodb_schema(self):
-
-        def get_schema():
-            try:
-                json = self._xodb_document.get_data()
-            except xapian.DatabaseError:
-                # _xodb_document has a pointer to a closed database
-                self._xodb_document = self._xodb_db.backend.get_document(self._id)
-                json = self._xodb_document.get_data()
-            typ, data = loads(json)
-            self._loaded = True
-            return _lookup_schema(typ).from_flat(data)
-
-        return self._xodb_db.retry_if_modified(get_schema, RETRY_LIMIT)
+        schema_type, data = _load_flat(self)
+        self._loaded = True
+        return schema_type.from_flat(data)
 
     def __getattr__(self, name):
         if self._xodb_db.use_values and not self._loaded:
             # short circuit expensive schema loading,
             # if value is available
             sort = self._xodb_db.value_sorts.get(name)
-            # TODO: date, datetime
-            if sort and sort in ('integer', 'string'):
+            if (sort in _value_decoders and
+                    name not in self._xodb_db.custom_values):
                 num = self._xodb_db.values[name]
                 def get_val():
                     return self._xodb_document.get_value(num)
                 val = self._xodb_db.retry_if_modified(get_val, 3)
-                if sort == 'integer':
-                    val = xapian.sortable_unserialise(val)
-                return val
+                try:
+                    return _decode_value(sort, val)
+                except ValueError:
+                    pass
         try:
             if name not in self._xodb_schema:
                 self._xodb_schema.setdefault(name)
@@ -133,6 +246,84 @@ def record_factory(database, doc, percent, rank, weight, query, db):
     return Record(doc, percent, rank, weight, query, db)
 
 
+def _load_flat(record):
+    """Decode a result's stored data into its schema class and its
+    flattened (key, value) pairs."""
+
+    def load():
+        try:
+            json = record._xodb_document.get_data()
+        except xapian.DatabaseError:
+            # _xodb_document has a pointer to a closed database
+            record._xodb_document = record._xodb_db.backend.get_document(
+                record._id)
+            json = record._xodb_document.get_data()
+        typ, data = loads(json)
+        return _lookup_schema(typ), data
+
+    return record._xodb_db.retry_if_modified(load, RETRY_LIMIT)
+
+
+class RecordView(object):
+    """Read-only, lightweight view of a search result.
+
+    Fields are looked up directly in the flattened data of the
+    document, which is decoded on first access.  Scalar fields are
+    adapted through their element class, container fields fall back
+    to building the full schema, as does `load`.
+    """
+
+    __slots__ = ('_id', '_xodb_document', '_xodb_percent', '_xodb_rank',
+                 '_xodb_weight', '_xodb_query', '_xodb_db',
+                 '_xodb_type', '_xodb_flat', '_xodb_schema')
+
+    def __init__(self, document, percent, rank, weight, query, db):
+        self._xodb_document = document
+        self._id = document.get_docid()
+        self._xodb_percent = percent
+        self._xodb_rank = rank
+        self._xodb_weight = weight
+        self._xodb_query = query
+        self._xodb_db = db
+        self._xodb_type = None
+        self._xodb_flat = None
+        self._xodb_schema = None
+
+    def _decode(self):
+        if self._xodb_flat is None:
+            self._xodb_type, data = _load_flat(self)
+            self._xodb_flat = dict(data)
+        return self._xodb_flat
+
+    def load(self):
+        """Build and return the full schema for this record."""
+        if self._xodb_schema is None:
+            self._decode()
+            self._xodb_schema = self._xodb_type.from_flat(
+                self._xodb_flat.iteritems())
+        return self._xodb_schema
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        flat = self._decode()
+        element = self._xodb_type.scalar_fields().get(name)
+        if element is not None:
+            if name not in flat:
+                return None
+            return element(flat[name]).value
+        schema = self.load()
+        try:
+            if name not in schema:
+                schema.setdefault(name)
+            return schema[name].value
+        except (KeyError, TypeError):
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return repr(self.load())
+
+
 class LanguageDecider(xapian.ExpandDecider):
     """
     A Xapian ExpandDecider that decide which terms to keep and which
@@ -185,6 +376,175 @@ class PrefixDecider(xapian.ExpandDecider):
         return term.startswith(self.prefix)
 
 
+class TermCountMatchSpy(xapian.MatchSpy):
+    """Match spy that counts, for each term starting with one of
+    *prefixes*, the number of matching documents it occurs in.
+
+    `total` is the number of documents the spy has seen, which is
+    less than the number of matches if the match was sampled.
+    """
+
+    def __init__(self, prefixes):
+        super(TermCountMatchSpy, self).__init__()
+        # sorted, so one pass over a termlist can skip to each prefix
+        self.prefixes = sorted(prefixes)
+        self.clear()
+
+    def clear(self):
+        self.counts = {}
+        self.total = 0
+
+    def __call__(self, doc, weight):
+        self.total += 1
+        counts = self.counts
+        terms = doc.termlist()
+        try:
+            for prefix in self.prefixes:
+                item = terms.skip_to(prefix)
+                while item.term.startswith(prefix):
+                    counts[item.term] = counts.get(item.term, 0) + 1
+                    item = terms.next()
+        except StopIteration:
+            pass
+
+
+def _prefixed_terms(terms, prefix):
+    """Generate the terms of a termlist that start with *prefix*."""
+    try:
+        item = terms.skip_to(prefix)
+        while item.term.startswith(prefix):
+            yield item.term
+            item = terms.next()
+    except StopIteration:
+        return
+
+
+class PivotMatchSpy(xapian.MatchSpy):
+    """Match spy that counts nested combinations of prefixed terms in
+    the matching documents, one level per prefix in *levels*.
+
+    `root` maps each term of the first level to a [count, children]
+    pair, where children maps the terms of the next level that occur
+    together with it in the same way.
+    """
+
+    def __init__(self, levels):
+        super(PivotMatchSpy, self).__init__()
+        self.levels = levels
+        self.clear()
+
+    def clear(self):
+        self.root = {}
+        self.total = 0
+
+    def __call__(self, doc, weight):
+        self.total += 1
+        terms = [list(_prefixed_terms(doc.termlist(), prefix))
+                 for prefix in self.levels]
+        self._count(self.root, terms)
+
+    def _count(self, node, levels):
+        rest = levels[1:]
+        for term in levels[0]:
+            entry = node.get(term)
+            if entry is None:
+                entry = node[term] = [0, {}]
+            entry[0] += 1
+            if rest:
+                self._count(entry[1], rest)
+
+
+# length of the raw date and datetime values truncated to a bucket
+_date_buckets = {'year': 4, 'month': 6, 'day': 8}
+_value_widths = {'date': 8, 'datetime': 14}
+
+
+def _value_buckets(name, sort, bucket, counts):
+    """Sum the counts of raw values of the value *name* into buckets,
+    keyed by the value range query that matches each bucket.
+
+    Numeric buckets are *bucket* wide, date and datetime buckets are a
+    'day', 'month' or 'year'.  Returns an OrderedDict in value order.
+    """
+    buckets = {}
+    if sort == 'integer':
+        bucket = int(bucket)
+        for raw, count in counts:
+            low = int(xapian.sortable_unserialise(raw)) // bucket * bucket
+            buckets[low] = buckets.get(low, 0) + count
+        ranges = ((low, '%s:%s..%s' % (name, low, low + bucket - 1))
+                  for low in buckets)
+    elif sort in _value_widths:
+        if bucket not in _date_buckets:
+            raise ValueError("Unknown date bucket %s" % bucket)
+        size = _date_buckets[bucket]
+        width = _value_widths[sort]
+        for raw, count in counts:
+            buckets[raw[:size]] = buckets.get(raw[:size], 0) + count
+        ranges = ((key, '%s:%s..%s' % (name,
+                                       key + '0' * (width - len(key)),
+                                       key + '9' * (width - len(key))))
+                  for key in buckets)
+    else:
+        raise ValueError("Can not bucket %s values" % sort)
+    return OrderedDict((query, buckets[key])
+                       for key, query in sorted(ranges))
+
+
+def _format_term(prefix, term):
+    """Format a prefixed term the way it is written in a query."""
+    return _format_facet(prefix, term[len(prefix) + 2:])
+
+
+def _format_facet(prefix, value):
+    if ' ' in value or '..' in value:
+        return '%s:"%s"' % (prefix, value)
+    return '%s:%s' % (prefix, value)
+
+
+def _result_document(result):
+    if isinstance(result, xapian.Document):
+        return result
+    return result._xodb_document
+
+
+def _cursor_queries(query, slot, value, reverse):
+    """Split the rest of a sorted scan after a page cursor's value
+    into the query for the documents with the same value, and the
+    query for those strictly past it, or None if there are none.
+    Empty values sort before all others and never match value
+    ranges.
+    """
+    if value:
+        ties = Query(Query.OP_FILTER, query,
+                     Query(Query.OP_VALUE_RANGE, slot, value, value))
+    else:
+        ties = Query(Query.OP_AND_NOT, query,
+                     Query(Query.OP_VALUE_GE, slot, '\x00'))
+    if not reverse:
+        # the smallest value larger than value
+        rest = Query(Query.OP_FILTER, query,
+                     Query(Query.OP_VALUE_GE, slot, value + '\x00'))
+    elif value:
+        rest = Query(Query.OP_AND_NOT, query,
+                     Query(Query.OP_VALUE_GE, slot, value))
+    else:
+        rest = None
+    return ties, rest
+
+
+def _encode_cursor(value, ties):
+    return base64.urlsafe_b64encode('%d:%s' % (ties, value))
+
+
+def _decode_cursor(cursor):
+    try:
+        ties, _, value = base64.urlsafe_b64decode(str(cursor)).partition(':')
+        return value, int(ties)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page cursor %r" % cursor)
+
+
 class MultipleValueRangeProcessor(xapian.ValueRangeProcessor):
     """Value range processor for multiple prefixes.
 
@@ -216,6 +576,16 @@ class MultipleValueRangeProcessor(xapian.ValueRangeProcessor):
         return (xapian.BAD_VALUENO, begin, end)
 
 
+# value range processor that handles each value sort
+_range_groups = {
+    'integer': 'numeric',
+    'string': 'string',
+    'date': 'string',
+    'boolean': 'string',
+    'datetime': 'datetime',
+    }
+
+
 def reconnector(func):
     @wraps(func)
     def _connect(db, *args, **kwargs):
@@ -245,6 +615,67 @@ def query_counter(func):
     return counter
 
 
+class ValueAllocator(object):
+    """Allocates value slot numbers to value names, in memory.
+
+    This is the default allocator of a Database.  It is seeded with
+    the slots stored in the database metadata whenever the metadata
+    is refreshed, so allocation never has to read the backend.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.count = 0
+
+    def seed(self, slots, count=0):
+        """Learn about slots that were allocated elsewhere."""
+        self.slots.update(slots)
+        self.count = max([self.count, count] + slots.values())
+
+    def allocate(self, name):
+        """Return the slot number for a value name, allocating a new
+        one if the name has none."""
+        slot = self.slots.get(name)
+        if slot is None:
+            self.count += 1
+            slot = self.slots[name] = self.count
+        return slot
+
+
+class SharedValueAllocator(ValueAllocator):
+    """A value allocator that can be shared by several writer
+    processes, i.e. for indexing in parallel, so that they all agree
+    on the slot of every value name.  The slots live in a
+    multiprocessing manager.
+
+    :param manager: A multiprocessing manager.  If None, a new one is
+    started.
+    """
+
+    def __init__(self, manager=None):
+        if manager is None:
+            manager = multiprocessing.Manager()
+        self.slots = manager.dict()
+        self.lock = manager.Lock()
+        self._count = manager.Value('i', 0)
+
+    def _get_count(self):
+        return self._count.value
+
+    def _set_count(self, count):
+        self._count.value = count
+
+    count = property(_get_count, _set_count)
+
+    def seed(self, slots, count=0):
+        with self.lock:
+            super(SharedValueAllocator, self).seed(slots, count)
+
+    def allocate(self, name):
+        with self.lock:
+            return super(SharedValueAllocator, self).allocate(name)
+
+
 class Database(object):
     """An xodb database.
 
@@ -263,6 +694,16 @@ class Database(object):
     replication mode (reopen() is never called, see xapian ticket
     #434)
 
+    :param value_allocator: The ValueAllocator used to allocate value
+    slots.  Pass a SharedValueAllocator to share allocation between
+    several writers.  If None, a private ValueAllocator is used.
+
+    :param reopen_policy: When read methods reopen the database to
+    see new revisions.  'always' reopens on every call, 'never' only
+    on errors or an explicit `refresh`, 'revision' only when the
+    database on disk has changed, and a number reopens at most once
+    every that many milliseconds.  Default: 'always'
+
     """
 
     record_factory = record_factory
@@ -271,15 +712,27 @@ class Database(object):
     boolean_prefix = "_XODB_BP_"
     value_prefix = "_XODB_VALUE_"
     value_sort_prefix = "_XODB_VALUESORT_"
+    value_custom_prefix = "_XODB_VALUECUSTOM_"
     value_count_name = "_XODB_COUNT_"
+    generation_name = "_XODB_GENERATION_"
+    rewrite_name = "_XODB_REWRITE_"
+    fingerprint_slot = 0  # never handed out by value allocators
+    key_prefix = "Q"
     backend = None
     _metadata_keyset = None
+    _metadata_generation = None
+    _metadata_rewrite = None
+    _global_revision = None
     query_cache_limit = 1024
+    query_page_sizes = (50, 200, 1000, 5000)
+    query_page_growth = 4
+    parser_pool_size = 8
+    suggest_rset_limit = 100
     use_values = True
 
     @contextmanager
-    def transaction(self):
-        self.begin()
+    def transaction(self, flushed=True):
+        self.begin(flushed)
         try:
             yield self
             self.commit()
@@ -307,22 +760,40 @@ class Database(object):
                  overwrite=False,
                  spelling=True,
                  replicated=False,
-                 inmem=False):
+                 inmem=False,
+                 value_allocator=None,
+                 reopen_policy='always'):
+        if not (reopen_policy in ('always', 'never', 'revision') or
+                isinstance(reopen_policy, (int, long, float))):
+            raise ValueError("Unknown reopen policy %r" % (reopen_policy,))
         self.db_path = path
         self._writable = writable
         self._overwrite = overwrite
         self.spelling = spelling
         self.replicated = replicated
         self.type_map = {}
-        self.parsers_by_language = {}
+        self.parsers_by_language = {}  # language -> [(epoch, parser)]
+        self._parser_lock = threading.Lock()
+        self._parser_epoch = 0
         self.relevance_prefixes = {}
         self.boolean_prefixes = {}
         self.values = {}
         self.value_sorts = {}
+        self.custom_values = set()
+        self._range_maps = dict((g, {}) for g in _range_groups.values())
         self.query_cache = LRUDict(limit=self.query_cache_limit)
+        # LRUDict reorders itself on reads, so every access is locked
+        self._cache_lock = threading.Lock()
         self.inmem = inmem
-        self._value_count = 0
+        self.value_allocator = value_allocator or ValueAllocator()
         self._timeout = 10000
+        self._term_generators = {}
+        self._spelling_supported = None
+        self._known_prefixes = set()
+        self.reopen_policy = reopen_policy
+        self._reopened_at = None
+        self._disk_revision = None
+        self._global_counts = {}
 
         if isinstance(path, basestring):
             if writable:
@@ -348,24 +819,73 @@ class Database(object):
             self.reconnect()
         self.reopen()
 
+    @property
+    def remote(self):
+        """True if the database was opened on a remote backend.  Match
+        spies and deciders written in python can not be sent to
+        remote backends."""
+        return isinstance(self.db_path, tuple)
+
     def get_query_parser(self, language, default_op, check_cache=True,
                          retry_limit=RETRY_LIMIT):
-        qp = None
-        if check_cache and not self.inmem:
-            qp = self.parsers_by_language.get(language)
-            if qp is not None:
-                return qp
+        """Return a new query parser for *language*, owned by the
+        caller.  It is never pooled, so *check_cache* is ignored; use
+        `query_parser` to borrow a pooled parser instead.
+        """
         def prepare_op():
             return self.prepare_query_parser(language, default_op)
-        qp = self.retry_if_modified(prepare_op, retry_limit)
-        if check_cache and not self.inmem:
-            self.parsers_by_language[language] = qp
-        return qp
+        return self.retry_if_modified(prepare_op, retry_limit)
+
+    @contextmanager
+    def query_parser(self, language, default_op=Query.OP_AND,
+                     retry_limit=RETRY_LIMIT):
+        """Borrow a query parser for *language* from the parser pool
+        for the duration of a with block.
+
+        A QueryParser can not be used by two threads at once, so each
+        thread checks out its own.  Up to `parser_pool_size` idle
+        parsers are kept per language, so parsers and their value
+        range processors are rarely rebuilt.
+        """
+        qp, epoch = self._checkout_parser(language, retry_limit)
+        qp.set_default_op(default_op)
+        try:
+            yield qp
+        finally:
+            self._return_parser(language, qp, epoch)
+
+    def _checkout_parser(self, language, retry_limit=RETRY_LIMIT):
+        with self._parser_lock:
+            pool = self.parsers_by_language.get(language)
+            if pool:
+                epoch, qp = pool.pop()
+                return qp, epoch
+            epoch = self._parser_epoch
+        def prepare_op():
+            return self.prepare_query_parser(language)
+        return self.retry_if_modified(prepare_op, retry_limit), epoch
+
+    def _return_parser(self, language, qp, epoch):
+        with self._parser_lock:
+            # parsers checked out before prefixes were added, or
+            # before a full refresh, are stale
+            if epoch != self._parser_epoch:
+                return
+            pool = self.parsers_by_language.setdefault(language, [])
+            if len(pool) < self.parser_pool_size:
+                pool.append((epoch, qp))
+
+    def _reset_parsers(self):
+        with self._parser_lock:
+            self.parsers_by_language = {}
+            self._parser_epoch += 1
 
     def reconnect(self):
         if self.backend is not None:
             self.backend.close()
             del self.backend
+        self._term_generators = {}
+        self._spelling_supported = None
         if self._writable:
             self.backend = xapian.remote_open_writable(*self.db_path)
         else:
@@ -380,8 +900,33 @@ class Database(object):
         self.backend.flush()
 
     def map(self, otype, schema):
-        """Map a type to a schema."""
+        """Map a type to a schema.  If the database is writable, the
+        schema's prefixes and values are registered."""
         self.type_map[otype] = schema
+        _register_schema(schema)
+        if self._writable:
+            self.register_schema(schema)
+
+    def register_schema(self, schema):
+        """Register the prefixes and value slots a schema's elements
+        generate up front, so indexing its documents only has to look
+        them up.  Data dependent names, like List members, are still
+        registered when first indexed.
+        """
+        prefixes, values = schema.declared_index()
+        for name, typ in prefixes:
+            if typ is None:
+                self.check_prefix(name)
+            else:
+                self.check_prefix(name, typ)
+        for name, sort in values:
+            if name not in self.values:
+                self.add_value(name, sort)
+        for name in schema.custom_values():
+            if name not in self.custom_values:
+                # readers must not decode these values by their sort
+                self.custom_values.add(name)
+                self._write_metadata(self.value_custom_prefix + name, '1')
 
     def schema_for(self, otype):
         """Get the schema for a given type, or one of its
@@ -394,22 +939,113 @@ class Database(object):
         raise TypeError("No schema defined for %s" % repr(otype))
 
     def _get_value_count(self):
-        if self.inmem:
-            return self._value_count
-        return int(self.backend.get_metadata(self.value_count_name) or 0)
+        return self.value_allocator.count
 
     def _set_value_count(self, count):
-        if self.inmem:
-            self._value_count = count
-        else:
+        self.value_allocator.count = count
+        self._store_value_count(count)
+
+    def _store_value_count(self, count):
+        if not self.inmem:
             self.backend.set_metadata(self.value_count_name, str(count))
 
     value_count = property(_get_value_count, _set_value_count)
 
+    def _write_metadata(self, key, value):
+        """Write a prefix or value registration to the backend, and
+        bring cached parsers and queries up to date with it.
+
+        The registration is written right away, so it is committed
+        with, or before, the first document that uses it.
+        """
+        old = self.backend.get_metadata(key)
+        self.backend.set_metadata(key, value)
+        generation = self._bump_generation()
+        if old and old != value:
+            # readers only read keys they have not seen, so a changed
+            # key makes them reload everything, and so does this one
+            self.backend.set_metadata(self.rewrite_name, generation)
+            self._reset_parsers()
+            with self._cache_lock:
+                self.query_cache = LRUDict(limit=self.query_cache_limit)
+        if isinstance(self._metadata_keyset, set):
+            # already applied, the next refresh must not apply it again
+            self._metadata_keyset.add(key)
+        self._refresh_caches([key])
+
+    def _refresh_caches(self, keys):
+        """Update the cached query parsers for newly applied metadata
+        keys, and drop the cached queries that mention their prefix or
+        value names.  Other cached queries could not have parsed
+        differently, so they are kept."""
+        names = set()
+        prefixes = []
+        rebuild = False
+        for k in keys:
+            if k.startswith(self.relevance_prefix):
+                name = k[len(self.relevance_prefix):]
+                if name not in self.boolean_prefixes:
+                    prefixes.append(('add_prefix', name,
+                                     self.relevance_prefixes[name]))
+            elif k.startswith(self.boolean_prefix):
+                name = k[len(self.boolean_prefix):]
+                if name in self.relevance_prefixes:
+                    # xapian refuses to add a boolean prefix that is
+                    # already a relevance prefix, new parsers prefer
+                    # the boolean one, like prepare_query_parser does
+                    rebuild = True
+                else:
+                    prefixes.append(('add_boolean_prefix', name,
+                                     self.boolean_prefixes[name]))
+            elif k.startswith(self.value_prefix):
+                name = k[len(self.value_prefix):]
+                self._map_value(name)
+            elif k.startswith(self.value_sort_prefix):
+                name = k[len(self.value_sort_prefix):]
+                self._map_value(name)
+            else:
+                continue
+            names.add(name)
+        if rebuild:
+            self._reset_parsers()
+        elif prefixes:
+            # update the idle parsers, checked out ones go stale
+            with self._parser_lock:
+                self._parser_epoch += 1
+                for pool in self.parsers_by_language.itervalues():
+                    for i, (epoch, qp) in enumerate(pool):
+                        for method, name, value in prefixes:
+                            getattr(qp, method)(name, value)
+                        pool[i] = (self._parser_epoch, qp)
+        if names and self.query_cache:
+            # queries are lowercased before they are parsed
+            marks = tuple(name.lower() + ':' for name in names)
+            with self._cache_lock:
+                for key in list(self.query_cache):
+                    query = key[0].lower()
+                    if any(mark in query for mark in marks):
+                        del self.query_cache[key]
+
+    def _map_value(self, name):
+        """Add a value to the shared map of the value range processor
+        for its sort, once both its slot and sort are known."""
+        group = _range_groups.get(self.value_sorts.get(name))
+        if group is not None and name in self.values:
+            self._range_maps[group][name] = self.values[name]
+
+    def _bump_generation(self):
+        """Bump the generation key, so readers notice changed metadata
+        without scanning the metadata keys."""
+        current = self._get_generation()
+        generation = str(int(current or 0) + 1)
+        self.backend.set_metadata(self.generation_name, generation)
+        if current == self._metadata_generation:
+            # nobody else changed metadata since our last refresh
+            self._metadata_generation = generation
+        return generation
+
     def check_prefix(self, name, boolean=False):
-        prefixes = set(self.relevance_prefixes.keys())
-        prefixes = prefixes.union(self.boolean_prefixes.keys())
-        if name not in prefixes:
+        if name not in self._known_prefixes:
             upped = _prefix(name)
             if boolean:
                 self.add_boolean_prefix(name, upped)
@@ -428,23 +1064,26 @@ class Database(object):
             else:
                 raise PrefixError('Conflicting relevance prefix %s', key)
         self.relevance_prefixes[key] = value
-        self.backend.set_metadata(self.relevance_prefix + key, value)
+        self._known_prefixes.add(key)
+        self._write_metadata(self.relevance_prefix + key, value)
 
     def add_boolean_prefix(self, key, value):
         """Add a boolean prefix mapping to the database.
         """
         self.boolean_prefixes[key] = value
-        self.backend.set_metadata(self.boolean_prefix + key, value)
+        self._known_prefixes.add(key)
+        self._write_metadata(self.boolean_prefix + key, value)
 
     def allocate_value_index(self, name):
-        """Default implementation of value index number allocation.
+        """Allocate a value index number with the database's
+        value_allocator.
 
-        Implement your own using shared something to keep several
-        databases in sync. i.e. for indexing in parallel.
+        Use a SharedValueAllocator to keep several databases in
+        sync. i.e. for indexing in parallel.
         """
-        value_count = self.value_count + 1
-        self.value_count = value_count
-        return value_count
+        value_index = self.value_allocator.allocate(name)
+        self._store_value_count(self.value_allocator.count)
+        return value_index
 
     def add_value(self, name, sort=None):
         """Add a value mapping to the database.
@@ -453,10 +1092,10 @@ class Database(object):
             return self.values[name]
         value_index = self.allocate_value_index(name)
         self.values[name] = value_index
-        self.backend.set_metadata(self.value_prefix + name, str(value_index))
+        self._write_metadata(self.value_prefix + name, str(value_index))
         if sort:
             self.value_sorts[name] = sort
-            self.backend.set_metadata(self.value_sort_prefix + name, sort)
+            self._write_metadata(self.value_sort_prefix + name, sort)
         return value_index
 
     def __nonzero__(self):
@@ -464,11 +1103,11 @@ class Database(object):
 
     def __len__(self):
         """ Return the number of documents in this database. """
-        self.reopen()
+        self.maybe_reopen()
         return self.backend.get_doccount()
 
     def allterms(self, prefix="", retry_limit=RETRY_LIMIT):
-        self.reopen()
+        self.maybe_reopen()
         seen = set()
         tries = 0
         # we can't use retry_if_modified because this
@@ -563,53 +1202,309 @@ class Database(object):
         :param validate: Validated the schema before the object is
         added.  Default: True
 
+        :param if_changed: If True, the document is only written if
+        the fingerprint of its memo differs from the fingerprint of
+        the existing document, and the fingerprint is stored with it.
+        Default: False
+
         Returns the xapan document that was added to the
-        database.
+        database, or None if it was unchanged.
         """
         assert self._writable, "Database is not writable"
         validate = kw.pop('validate', True)
         schema_type = kw.pop('schema_type', None)
+        if_changed = kw.pop('if_changed', False)
         if not isinstance(obj, xapian.Document):
-            doc = self.to_document(obj, schema_type=schema_type,
-                                   validate=validate)
+            memo = self.to_memo(obj, schema_type=schema_type,
+                                validate=validate)
+            fingerprint = None
+            if if_changed:
+                fingerprint = memo.fingerprint()
+                if self.fingerprint(docid) == fingerprint:
+                    return None
+            doc = self.memo_to_document(memo, fingerprint)
         else:
             doc = obj
         self.backend.replace_document(int(docid), doc)
         return doc
 
+    def fingerprint(self, docid):
+        """Return the memo fingerprint stored with a document, or None
+        if there is no such document or it has no fingerprint.
+        """
+        doc = self.get(int(docid))
+        if doc is None:
+            return None
+        return doc.get_value(self.fingerprint_slot) or None
+
+    def key_term(self, key):
+        """Return the reserved boolean term that identifies the
+        document with the unique key *key*.
+        """
+        if not isinstance(key, basestring):
+            key = unicode(key)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.key_prefix + key
+
+    def _keyed_document(self, obj, schema_type, validate):
+        if isinstance(obj, Memo):
+            memo = obj
+        else:
+            memo = self.to_memo(obj, schema_type=schema_type,
+                                validate=validate)
+        if memo.key is None:
+            raise UniqueKeyRequired(
+                "%r has no unique key, set unique_key on its schema "
+                "and a value for it" % obj)
+        return self.key_term(memo.key), self.memo_to_document(memo)
+
+    def upsert(self, obj, schema_type=None, validate=True):
+        """Add an object to the database, replacing any document with
+        the same unique key.  The object's schema must declare a
+        `unique_key` element.
+
+        :param obj: The mapped object or memo to add.
+
+        :param schema_type: Specify the schema to be used. (optional)
+
+        :param validate: Validated the schema before the object is
+        added.  Default: True
+
+        Returns the document id of the added or replaced document.
+        """
+        assert self._writable, "Database is not writable"
+        term, doc = self._keyed_document(obj, schema_type, validate)
+        return self.backend.replace_document(term, doc)
+
+    def upsert_many(self, objs, batch_size=1000, commit_every=None,
+                    schema_type=None, validate=True, progress=None):
+        """Upsert a stream of objects in batches, see `upsert` and
+        `add_stream`.
+
+        Returns the number of documents that were written.
+        """
+        assert self._writable, "Database is not writable"
+
+        def prepare(obj):
+            return self._keyed_document(obj, schema_type, validate)
+
+        def write(item):
+            self.backend.replace_document(*item)
+
+        written, skipped = self._write_stream(
+            objs, prepare, write, batch_size, commit_every, progress)
+        return written
+
+    def delete_by_key(self, key):
+        """Delete the document with the unique key *key*, if any."""
+        assert self._writable, "Database is not writable"
+        self.backend.delete_document(self.key_term(key))
+
+    def add_parallel(self, objs, processes=None, chunksize=100,
+                     batch_size=1000, commit_every=None,
+                     schema_type=None, validate=True, progress=None):
+        """Add a stream of objects to the database, generating their
+        memos in a pool of worker processes.
+
+        The object->schema->memo transformation runs in
+        *processes* worker processes (default: one per cpu) while
+        this process turns the memos into xapian documents and writes
+        them with `add_stream`.  Documents are added in the same order
+        as *objs*.  Objects and their schemas must be picklable.
+
+        :param chunksize: Number of objects sent to a worker at a time.
+
+        The remaining arguments are passed on to `add_stream`.
+
+        Returns the number of documents that were added.
+        """
+        assert self._writable, "Database is not writable"
+        processes = processes or multiprocessing.cpu_count()
+        tasks = ((schema_type or self.schema_type_for(obj), obj, validate)
+                 for obj in objs)
+        pool = multiprocessing.Pool(processes)
+        try:
+            # memos travel as pickles, the pure python binary memo
+            # format is much slower to encode and decode than cPickle
+            memos = _imap_windowed(pool, _memo_worker, tasks, chunksize,
+                                   processes * chunksize * 4)
+            added = self.add_stream(memos,
+                                    batch_size=batch_size,
+                                    commit_every=commit_every,
+                                    progress=progress)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return added
+
+    def add_stream(self, objs, batch_size=1000, commit_every=None,
+                   schema_type=None, validate=True, progress=None):
+        """Add a stream of objects to the database in batches.
+
+        Objects are consumed lazily from *objs*, so it can be a
+        generator over any number of objects.  No more than one batch
+        of documents is held in memory at a time, and each batch is
+        added inside its own transaction.
+
+        :param objs: An iterable of mapped objects, memos or xapian
+        documents.
+
+        :param batch_size: The number of documents added per
+        transaction.  Default: 1000
+
+        :param commit_every: If provided, batches are added in
+        unflushed transactions and the database is only flushed after
+        at least this many documents.  If None (the default), every
+        batch is flushed when its transaction commits.
+
+        :param schema_type: Specify the schema to be used. (optional)
+
+        :param validate: Validated the schema before the object is
+        added.  Default: True
+
+        :param progress: Optional callable that is called after each
+        batch with the number of documents added so far and the
+        elapsed time in seconds.
+
+        Returns the number of documents that were added.
+        """
+        assert self._writable, "Database is not writable"
+        to_document = self.to_document
+        memo_to_document = self.memo_to_document
+
+        def prepare(obj):
+            if isinstance(obj, Memo):
+                return memo_to_document(obj)
+            elif not isinstance(obj, xapian.Document):
+                return to_document(obj, schema_type=schema_type,
+                                   validate=validate)
+            return obj
+
+        added, skipped = self._write_stream(
+            objs, prepare, self.backend.add_document,
+            batch_size, commit_every, progress)
+        return added
+
+    def sync_stream(self, items, batch_size=1000, commit_every=None,
+                    schema_type=None, validate=True, progress=None):
+        """Replace a stream of documents, skipping the ones that did
+        not change.
+
+        Like `add_stream`, but *items* is an iterable of (docid, obj)
+        pairs.  A document is only rewritten if the fingerprint of
+        the object's memo differs from the one stored with the
+        existing document, see `replace`.
+
+        Returns a (written, skipped) tuple of document counts.
+        """
+        assert self._writable, "Database is not writable"
+        to_memo = self.to_memo
+
+        def prepare(item):
+            docid, obj = item
+            memo = to_memo(obj, schema_type=schema_type, validate=validate)
+            fingerprint = memo.fingerprint()
+            if self.fingerprint(docid) == fingerprint:
+                return None
+            return int(docid), self.memo_to_document(memo, fingerprint)
+
+        def write(item):
+            self.backend.replace_document(*item)
+
+        return self._write_stream(items, prepare, write,
+                                  batch_size, commit_every, progress)
+
+    def _write_stream(self, items, prepare, write,
+                      batch_size, commit_every, progress):
+        """Batching loop shared by the stream methods.  *prepare* turns
+        an item into an argument for *write*, or None to skip it.
+        Returns a (written, skipped) tuple."""
+        flushed = commit_every is None
+        items = iter(items)
+        written = skipped = pending = 0
+        start = time.time()
+        while True:
+            batch = []
+            size = 0
+            for item in islice(items, batch_size):
+                size += 1
+                item = prepare(item)
+                if item is None:
+                    skipped += 1
+                else:
+                    batch.append(item)
+            if not size:
+                break
+            if batch:
+                with self.transaction(flushed):
+                    for item in batch:
+                        write(item)
+            written += len(batch)
+            pending += len(batch)
+            del batch
+            if not flushed and pending >= commit_every:
+                self.flush()
+                pending = 0
+            elapsed = time.time() - start
+            logger.debug('Wrote %s documents in %.2fs', written, elapsed)
+            if progress is not None:
+                progress(written, elapsed)
+        if pending and not flushed:
+            self.flush()
+        elapsed = time.time() - start
+        logger.info('Wrote %s documents, skipped %s, in %.2fs '
+                    '(%.1f docs/s)', written, skipped, elapsed,
+                    (written + skipped) / elapsed if elapsed else 0.0)
+        return written, skipped
+
     def to_schema(self, obj, validate=True, schema_type=None):
         """
         Turn an object into an schema instance which is fully
         populated with data from the object.  Optionally validate.
         """
         if not schema_type:
-            if hasattr(obj, '__xodb_schema__'):
-                schema_type = obj.__xodb_schema__
-            else:
-                schema_type = self.schema_for(type(obj))
-        schema = schema_type.from_defaults()
-        schema.__xodb_db__ = self
-        schema.update_by_object(obj)
-
-        if validate and not schema.validate():
-            invalid = []
-            for child in schema.all_children:
-                if not child.valid:
-                    invalid.append(child)
-            raise ValidationError("Elements of %s did not validate %s:" %
-                                  (schema.__class__.__name__,
-                                   list((c.name, c.value)
-                                        for c in invalid)))
-        return schema
+            schema_type = self.schema_type_for(obj)
+        return _build_schema(schema_type, obj, validate, self)
 
-    def to_document(self, obj, validate=True, schema_type=None):
+    def schema_type_for(self, obj):
+        """Get the schema for an object, either from its
+        __xodb_schema__ attribute or from its mapped type."""
+        if hasattr(obj, '__xodb_schema__'):
+            return obj.__xodb_schema__
+        return self.schema_for(type(obj))
+
+    def to_memo(self, obj, validate=True, schema_type=None):
         """
-        Convienient wrapper that does the object->schema->document
+        Convienient wrapper that does the object->schema->memo
         transformation.
         """
         if not isinstance(obj, Schema):
             obj = self.to_schema(obj, validate, schema_type)
-        return self.doc_from_dict(obj.__xodb_memo__.dict)
+        return obj.__xodb_memo__
+
+    def to_document(self, obj, validate=True, schema_type=None):
+        """
+        Convienient wrapper that does the object->schema->document
+        transformation.
+        """
+        return self.memo_to_document(self.to_memo(obj, validate,
+                                                  schema_type))
+
+    def memo_to_document(self, memo, fingerprint=None):
+        """Turn a memo into a xapian document.  If a *fingerprint* of
+        the memo is given, it is stored in the reserved fingerprint
+        value slot.  Only `replace` with if_changed and `sync_stream`
+        compute fingerprints, they cost a full encoding of the memo.
+        """
+        doc = self.doc_from_dict(memo.dict)
+        if fingerprint is not None:
+            doc.add_value(self.fingerprint_slot, fingerprint)
+        return doc
 
     def doc_from_dict(self, data):
         """Take an intermediate representation of a document (a
@@ -618,6 +1513,10 @@ class Database(object):
         """
         doc = xapian.Document()
 
+        key = data.get('key')
+        if key is not None:
+            doc.add_term(self.key_term(key), 0)
+
         for term_tup in data.get('terms', ()):
             term = None
             typ = None
@@ -639,8 +1538,8 @@ class Database(object):
             lang = text_dict.get('lang')
             el_start_pos = text_dict.get('position_start', None)
 
-            tg = xapian.TermGenerator()
-            tg.set_database(self.backend)
+            spelling = bool(text_dict.get('spell', True)) and self.can_spell
+            tg = self._term_generator(lang, spelling)
             tg.set_document(doc)
 
             # if the element specifies no start position, set the
@@ -650,17 +1549,6 @@ class Database(object):
             else:
                 tg.set_termpos(all_start_pos)
 
-            spelling = text_dict.get('spell', True)
-            if spelling:
-                try:
-                    # hack to workaround missing spelling for inmem backends
-                    self.backend.add_spelling('food')
-                    tg.set_flags(xapian.TermGenerator.FLAG_SPELLING)
-                except:
-                    pass  # noop for backends that don't support spelling
-            if lang in snowball.stoppers:
-                tg.set_stemmer(xapian.Stem(lang))
-                tg.set_stopper(snowball.stoppers[lang])
             if text_dict.get('post', True):
                 index_text = tg.index_text
             else:
@@ -695,11 +1583,45 @@ class Database(object):
             doc.set_data(data)
         return doc
 
+    @property
+    def can_spell(self):
+        """True if the backend supports spelling data.  Detected once
+        per backend."""
+        if self._spelling_supported is None:
+            try:
+                # hack to workaround missing spelling for inmem backends
+                self.backend.add_spelling('food')
+                self.backend.remove_spelling('food')
+                self._spelling_supported = True
+            except Exception:
+                self._spelling_supported = False
+        return self._spelling_supported
+
+    def _term_generator(self, lang, spelling):
+        """Return a term generator configured for a language, cached
+        and reused for every text indexed in that language."""
+        key = (lang, spelling)
+        tg = self._term_generators.get(key)
+        if tg is None:
+            tg = xapian.TermGenerator()
+            tg.set_database(self.backend)
+            if spelling:
+                tg.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+            if lang in snowball.stoppers:
+                tg.set_stemmer(xapian.Stem(lang))
+                tg.set_stopper(snowball.stoppers[lang])
+            self._term_generators[key] = tg
+        return tg
+
     def reopen(self, retry_limit=RETRY_LIMIT, refresh_if_needed=True):
         """
         Reopen the database.  Called before most query methods.  If
         replication is used, the db is closed and reopened.
         """
+        if self.reopen_policy == 'revision':
+            # taken first, so a commit racing the reopen leaves an
+            # older token and is picked up by the next maybe_reopen
+            revision = self._get_disk_revision()
         if not self.replicated:
             self.backend.reopen()
         else:
@@ -709,18 +1631,94 @@ class Database(object):
                                   "using replication.")
             self.close()
             self.backend = xapian.Database(self.db_path)
-            # reset cached parsers to new database object
-            for parser in self.parsers_by_language.itervalues():
-                parser.set_database(self.backend)
+            # reset pooled parsers to new database object, checked
+            # out ones set it themselves when they are retried
+            with self._parser_lock:
+                for pool in self.parsers_by_language.itervalues():
+                    for epoch, parser in pool:
+                        parser.set_database(self.backend)
+
+        self._reopened_at = time.time()
+        if self.reopen_policy == 'revision':
+            self._disk_revision = revision
 
         if refresh_if_needed and self.is_metadata_changed:
             self.meta_refresh()
 
-    def begin(self):
+    def maybe_reopen(self):
+        """Reopen the database if the reopen policy calls for it.
+        Called before read methods.
+        """
+        policy = self.reopen_policy
+        if policy == 'always':
+            self.reopen()
+        elif policy == 'never':
+            return
+        elif policy == 'revision':
+            revision = self._get_disk_revision()
+            if revision is None or revision != self._disk_revision:
+                self.reopen()
+        elif (time.time() - self._reopened_at) * 1000 >= policy:
+            self.reopen()
+
+    def refresh(self):
+        """Reopen the database now, regardless of the reopen policy."""
+        self.reopen()
+
+    def _get_disk_revision(self):
+        """Return a token that changes when a new revision of the
+        database is committed to disk, or None if the database is not
+        a local directory.  Commits replace the database's base files,
+        so their names, sizes and modification times are the token.
+        """
+        if not isinstance(self.db_path, basestring):
+            return None
+        try:
+            names = os.listdir(self.db_path)
+            return frozenset(
+                (name, st.st_size, st.st_mtime) for name, st in
+                ((name, os.stat(os.path.join(self.db_path, name)))
+                 for name in names))
+        except OSError:
+            return None
+
+    def _global_cache(self):
+        """Return the cache of counts over the whole database, emptied
+        when the database changes.  The disk revision and the
+        database's statistics tell the revisions apart, so changes
+        that are not yet flushed to disk are seen as long as they
+        change the document count or length.
+        """
+        revision = (self._get_disk_revision(),
+                    self.backend.get_doccount(),
+                    self.backend.get_lastdocid(),
+                    self.backend.get_avlength())
+        if revision != self._global_revision:
+            self._global_revision = revision
+            self._global_counts = {}
+        return self._global_counts
+
+    def _global_facets(self, prefix, retry_limit=RETRY_LIMIT):
+        """Return the (term, count) pairs of a facet prefix over the
+        whole database, the most frequent first.  The counts are the
+        frequencies of the prefix's terms, no match is run.
+        """
+        cache = self._global_cache()
+        key = ('facets', prefix)
+        if key not in cache:
+            def op():
+                return [(item.term, item.termfreq) for item in
+                        self.backend.allterms(_prefix(prefix))]
+            counts = self.retry_if_modified(op, retry_limit)
+            counts.sort(key=itemgetter(1), reverse=True)
+            cache[key] = counts
+        return cache[key]
+
+    def begin(self, flushed=True):
         if self._writable:
             self.reopen()
             try:
-                self.backend.begin_transaction()
+                self.backend.begin_transaction(flushed)
             except Exception:
                 pass  # noop for backends that don't support transactions
 
@@ -758,33 +1756,30 @@ class Database(object):
                     logger.warning(
                         'Duplicate relevance prefix %s conflicts with boolean',
                         key)
-        if self.value_sorts:
-            # First add numeric values ranges
-            qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
-                dict(((k, self.values[k])
-                      for k, v in self.value_sorts.items() if v == 'integer')),
-                serializer=lambda s: xapian.sortable_serialise(
-                    float(s) if s else float('-inf')),
-                end_serializer=lambda s: xapian.sortable_serialise(
-                    float(s) if s else float('inf')),
-            ))
-            # Then string and date
-            qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
-                dict(((k, self.values[k])
-                      for k, v in self.value_sorts.items() if v in
-                        ('string', 'date'))),
-            ))
-            # Serialize date range queries so that they are inclusive.
-            # This allows datetime value range queries to be treated
-            # as [begin,end] rather than [begin,end) as is the default
-            # without these serializers when then datetime range arguments
-            # are not fully qualified.
-            qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
-                dict(((k, self.values[k])
-                      for k, v in self.value_sorts.items() if v == 'datetime')),
-                serializer = lambda x: x + '0'*(14-len(x)),
-                end_serializer = lambda x: x + '9'*(14-len(x))
-            ))
+        # The processors share the database's range maps, so values
+        # added later are picked up by cached parsers.
+        # First add numeric values ranges
+        qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
+            self._range_maps['numeric'],
+            serializer=lambda s: xapian.sortable_serialise(
+                float(s) if s else float('-inf')),
+            end_serializer=lambda s: xapian.sortable_serialise(
+                float(s) if s else float('inf')),
+        ))
+        # Then string and date
+        qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
+            self._range_maps['string'],
+        ))
+        # Serialize date range queries so that they are inclusive.
+        # This allows datetime value range queries to be treated
+        # as [begin,end] rather than [begin,end) as is the default
+        # without these serializers when then datetime range arguments
+        # are not fully qualified.
+        qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
+            self._range_maps['datetime'],
+            serializer = lambda x: x + '0'*(14-len(x)),
+            end_serializer = lambda x: x + '9'*(14-len(x))
+        ))
         if language in snowball.stoppers:
             qp.set_stemmer(xapian.Stem(language))
             qp.set_stopper(snowball.stoppers[language])
@@ -793,8 +1788,25 @@ class Database(object):
 
     @property
     def is_metadata_changed(self):
+        """True if the stored metadata changed since the last refresh.
+
+        Writers bump a generation key whenever they write metadata, so
+        only that key is compared.  Databases without one, written
+        before it was introduced, fall back to comparing the set of
+        metadata keys.  Code that sets xodb metadata directly on the
+        backend must bump the generation as well.
+        """
+        if self.inmem:
+            return False
+        generation = self._get_generation()
+        if generation:
+            return generation != self._metadata_generation
         return self._metadata_keyset != self._get_metadata_keyset()
 
+    def _get_generation(self, retry_limit=RETRY_LIMIT):
+        op = lambda: self.backend.get_metadata(self.generation_name)
+        return self.retry_if_modified(op, retry_limit, False)
+
     def _get_metadata_keyset(self, retry_limit=RETRY_LIMIT):
         if self.inmem:
             return False
@@ -802,35 +1814,73 @@ class Database(object):
         # don't recurse into refresh here, just reopen and retry
         return self.retry_if_modified(op, retry_limit, False)
 
-    def meta_refresh(self, retry_limit=RETRY_LIMIT):
-        if not self.inmem:
-            self.parsers_by_language = {}
+    def meta_refresh(self, retry_limit=RETRY_LIMIT, full=False):
+        """Load the prefix and value metadata from the backend.
+
+        Only the keys added since the last refresh are read, and
+        cached parsers and queries are updated for them, see
+        `_refresh_caches`.  If *full* is True, or keys were removed or
+        rewritten with a new value, all metadata is reloaded and the
+        caches are dropped.
+        """
+        if self.inmem:
+            return
+        generation = self._get_generation()
+        keyset = self._get_metadata_keyset()
+        known = self._metadata_keyset
+        op = lambda: self.backend.get_metadata(self.rewrite_name)
+        rewrite = self.retry_if_modified(op, retry_limit, False) or None
+        full = (full or known is None or not known <= keyset or
+                rewrite != self._metadata_rewrite)
+        self._metadata_rewrite = rewrite
+        if full:
+            self._reset_parsers()
             self.relevance_prefixes = {}
             self.boolean_prefixes = {}
             self.values = {}
             self.value_sorts = {}
+            self.custom_values = set()
+            self._range_maps = dict((g, {}) for g in _range_groups.values())
+            self._known_prefixes = set()
             self.query_cache = LRUDict(limit=self.query_cache_limit)
-
-            self._metadata_keyset = self._get_metadata_keyset()
-            for k in self._metadata_keyset:
-                op = lambda: self.backend.get_metadata(k)
-                val = self.retry_if_modified(op, retry_limit, False)
-                if k.startswith(self.relevance_prefix):
-                    prefix = k[len(self.relevance_prefix):]
-                    self.relevance_prefixes[prefix] = val
-                elif k.startswith(self.boolean_prefix):
-                    prefix = k[len(self.boolean_prefix):]
-                    self.boolean_prefixes[prefix] = val
-                elif k.startswith(self.value_prefix):
-                    value = k[len(self.value_prefix):]
-                    self.values[value] = int(val)
-                elif k.startswith(self.value_sort_prefix):
-                    value = k[len(self.value_sort_prefix):]
-                    self.value_sorts[value] = val
+            added = keyset
+        else:
+            added = keyset - known
+        self._metadata_generation = generation
+        self._metadata_keyset = keyset
+
+        # the value count changes without adding a key
+        for k in added | (keyset & set([self.value_count_name])):
+            op = lambda: self.backend.get_metadata(k)
+            val = self.retry_if_modified(op, retry_limit, False)
+            self._apply_metadata(k, val)
+        if full:
+            for name in self.values:
+                self._map_value(name)
+        else:
+            self._refresh_caches(added)
+        self.value_allocator.seed(self.values)
+
+    def _apply_metadata(self, k, val):
+        if k.startswith(self.relevance_prefix):
+            prefix = k[len(self.relevance_prefix):]
+            self.relevance_prefixes[prefix] = val
+            self._known_prefixes.add(prefix)
+        elif k.startswith(self.boolean_prefix):
+            prefix = k[len(self.boolean_prefix):]
+            self.boolean_prefixes[prefix] = val
+            self._known_prefixes.add(prefix)
+        elif k.startswith(self.value_prefix):
+            value = k[len(self.value_prefix):]
+            self.values[value] = int(val)
+        elif k.startswith(self.value_sort_prefix):
+            value = k[len(self.value_sort_prefix):]
+            self.value_sorts[value] = val
+        elif k.startswith(self.value_custom_prefix):
+            self.custom_values.add(k[len(self.value_custom_prefix):])
+        elif k == self.value_count_name:
             try:
-                # hit the property to refresh this value
-                count = self.value_count
-                count = count  # pyflakes
+                self.value_allocator.seed({}, int(val or 0))
             except ValueError:
                 if self._writable:
                     self.value_count = 0
@@ -860,19 +1910,23 @@ class Database(object):
                 return Query("")
             else:
                 cache_key = (query, language, translit, default_op, parser_flags)
-                if cache_key in self.query_cache:
-                    return self.query_cache[cache_key]
+                with self._cache_lock:
+                    result = self.query_cache.get(cache_key)
+                if result is not None:
+                    return result
                 query = query.lower()
                 if translit:
                     query = query.encode(translit)
 
-                qp = self.get_query_parser(language, default_op,
-                                           retry_limit=retry_limit)
-                def query_op():
-                    return qp.parse_query(query, parser_flags)
-                result = self.retry_if_modified(query_op, retry_limit)
+                with self.query_parser(language, default_op,
+                                       retry_limit) as qp:
+                    def query_op():
+                        qp.set_database(self.backend)
+                        return qp.parse_query(query, parser_flags)
+                    result = self.retry_if_modified(query_op, retry_limit)
                 if not self.inmem:
-                    self.query_cache[cache_key] = result
+                    with self._cache_lock:
+                        self.query_cache[cache_key] = result
                 return result
         else:
             return reduce(partial(Query, default_op),
@@ -895,6 +1949,8 @@ class Database(object):
               match_decider=None,
               match_spy=None,
               document=False,
+              view=False,
+              fields=None,
               echo=False,
               disimilate=False,
               disimilate_field='nilsimsa',
@@ -907,6 +1963,14 @@ class Database(object):
         Query the database with the provided string or xapian Query
         object.  A string is passed into xapians QueryParser first to
         generate a Query object.
+
+        If *view* is True, results are returned as read-only
+        RecordView objects instead of through the record_factory.
+
+        If *fields* is a list of field names, results are returned as
+        dictionaries of just those fields.  Fields stored in value
+        slots are read from the slots, and the document data is only
+        decoded if some field is not.
         """
         # Only reopen the database if this is the only query.
         # Re-opening the database will invalidate the parent Enquire
@@ -914,7 +1978,7 @@ class Database(object):
         if self.query_count == 1:
             if echo:
                 print 'Reopening'
-            self.reopen()
+            self.maybe_reopen()
 
         def get_enquire():
             # Enquire requires a reference to the currently opened backend
@@ -930,16 +1994,19 @@ class Database(object):
 
         enq = get_enquire()
 
-        limit = limit or self.backend.get_doccount()
-
         if echo:
-            start = time.time()
             print "Fetching mset..."
 
         # convoluted logic here is to retry queries that die in the
         # middle of result iteration because the db was closed (due to
         # replication).
 
+        make_record = RecordView if view else self.record_factory
+        if fields is not None:
+            extra = disimilate and disimilate_field not in fields
+            if extra:
+                fields = list(fields) + [disimilate_field]
+            project = partial(self._project, *self._projection(fields))
         tries = 0
         seen = set()
         disimilator = LRUDict(limit=disimilate_window)
@@ -949,13 +2016,9 @@ class Database(object):
         while True:
             try:
                 # _build_mset may retry internally on DatabaseError
-                mset = self._build_mset(enq, offset, limit, order, reverse,
-                                        check, match_decider, match_spy,
-                                        retry_limit=retry_limit)
-                if echo:
-                    print "Fetched mset in %s" % str(time.time() - start)
-
-                for record in mset:
+                for record in chain.from_iterable(self._mset_pages(
+                        enq, offset, limit, order, reverse, check,
+                        match_decider, match_spy, retry_limit, echo)):
                     doc = record.document
                     docid = doc.get_docid()
                     if docid in seen:
@@ -965,16 +2028,25 @@ class Database(object):
                         yield doc
                     else:
                         seen.add(docid)
-                        record = self.record_factory(doc,
-                                                     record.percent,
-                                                     record.rank,
-                                                     record.weight,
-                                                     query,
-                                                     self,
-                                                     )
+                        if fields is not None:
+                            record = project(doc, record)
+                        else:
+                            record = make_record(doc,
+                                                 record.percent,
+                                                 record.rank,
+                                                 record.weight,
+                                                 query,
+                                                 self,
+                                                 )
                         if disimilate:
                             yield_it = True
-                            rhash = getattr(record, disimilate_field, None)
+                            if fields is None:
+                                rhash = getattr(record, disimilate_field,
+                                                None)
+                            elif extra:
+                                rhash = record.pop(disimilate_field)
+                            else:
+                                rhash = record[disimilate_field]
                             if rhash:
                                 if rhash in disimilator or any(
                                     (_simhash_distance(rhash, h)
@@ -1002,6 +2074,133 @@ class Database(object):
                 logger.info('Replaying database query.')
                 tries += 1
 
+    def page(self, query, order, limit=20, cursor=None, reverse=False,
+             **kw):
+        """Return a page of results sorted by the value *order*, and a
+        cursor for the next page.
+
+        Unlike paging with an offset, the cursor holds the sort value
+        of the last result, and the next page continues the scan from
+        there with a value range, so deep pages cost about the same as
+        the first one.  Documents sharing the cursor's sort value are
+        ordered by docid, the cursor also holds how many of them were
+        already returned, and they are skipped with an offset into
+        just that value.  New documents get larger docids and so do
+        not shift that offset, deleting one of them between pages
+        does.
+
+        :param query: The query, as for `query`.
+
+        :param order: The name of the value to sort by.
+
+        :param limit: The number of results per page.  Default: 20
+
+        :param cursor: The cursor returned with the previous page, or
+        None for the first page.
+
+        :param reverse: Sort in descending order.  Default: False
+
+        Other keyword arguments are passed to `query`, except for
+        fields, as projected results carry no document to build the
+        cursor from.
+
+        Returns a (records, cursor) tuple.  The cursor is None after
+        the last page.
+        """
+        if kw.get('fields') is not None:
+            raise TypeError("Pages can not be projected with fields")
+        try:
+            slot = self.values[order]
+        except KeyError:
+            raise ValueError("There is no sort name %s" % order)
+        query = self.querify(query,
+                             kw.get('language'),
+                             kw.get('translit'),
+                             kw.get('default_op', Query.OP_AND),
+                             kw.get('parser_flags', default_parser_flags))
+        records = []
+        value = None
+        skip = 0
+        if cursor is not None:
+            value, skip = _decode_cursor(cursor)
+            ties, query = _cursor_queries(query, slot, value, reverse)
+            records.extend(self.query(ties, offset=skip, limit=limit,
+                                      order=slot, reverse=reverse, **kw))
+        if query is not None and len(records) < limit:
+            records.extend(self.query(query, limit=limit - len(records),
+                                      order=slot, reverse=reverse, **kw))
+        if len(records) < limit:
+            return records, None
+        last = _result_document(records[-1]).get_value(slot)
+        ties = 0
+        for record in reversed(records):
+            if _result_document(record).get_value(slot) != last:
+                break
+            ties += 1
+        if ties == len(records) and last == value:
+            # the whole page continued the cursor's value
+            ties += skip
+        return records, _encode_cursor(last, ties)
+
+    def _mset_pages(self, enq, offset, limit, order, reverse, check,
+                    match_decider, match_spy, retry_limit, echo=False):
+        """Generate the msets for a query.
+
+        With a limit, or a match spy that has to see the whole match
+        once, that is a single mset.  Otherwise msets of growing
+        query_page_sizes are fetched as the previous one is consumed,
+        until the matches are exhausted.  Past the last of those sizes,
+        each mset is query_page_growth times larger than the previous
+        one, since every mset runs the match again, so reading all
+        matches takes a number of matches logarithmic in their count.
+        """
+        if limit or match_spy is not None:
+            sizes = [limit or self.backend.get_doccount()]
+        else:
+            sizes = chain(self.query_page_sizes,
+                          _grow(self.query_page_sizes[-1],
+                                self.query_page_growth))
+        start = time.time()
+        for size in sizes:
+            mset = self._build_mset(enq, offset, size, order, reverse,
+                                    check, match_decider, match_spy,
+                                    retry_limit=retry_limit)
+            if echo:
+                print "Fetched mset in %s" % str(time.time() - start)
+            yield mset
+            if mset.size() < size:
+                break
+            offset += size
+
+    def _projection(self, fields):
+        """Split *fields* into those that can be read from value slots,
+        as (name, slot, sort) tuples, and the names of the rest."""
+        covered = []
+        uncovered = []
+        for name in fields:
+            sort = self.value_sorts.get(name) if self.use_values else None
+            if (sort in _value_decoders and name in self.values and
+                    name not in self.custom_values):
+                covered.append((name, self.values[name], sort))
+            else:
+                uncovered.append(name)
+        return covered, uncovered
+
+    def _project(self, covered, uncovered, doc, match):
+        """Build the dictionary of projected fields for a match."""
+        row = {}
+        for name, slot, sort in covered:
+            try:
+                row[name] = _decode_value(sort, doc.get_value(slot))
+            except ValueError:
+                uncovered = uncovered + [name]
+        if uncovered:
+            view = RecordView(doc, match.percent, match.rank, match.weight,
+                              None, self)
+            for name in uncovered:
+                row[name] = getattr(view, name, None)
+        return row
+
     @reconnector
     def count(self,
               query="",
@@ -1016,7 +2215,7 @@ class Database(object):
         object.  A string is passed into xapians QueryParser first to
         generate a Query object.
         """
-        self.reopen()
+        self.maybe_reopen()
         query = self.querify(query, language, translit, default_op, parser_flags)
         if echo:
             print str(query)
@@ -1038,40 +2237,203 @@ class Database(object):
               echo=False,
               retry_limit=RETRY_LIMIT,
               include_query_terms=True):
-        """Get facet suggestions for the query, then the query with
-        each suggested facet, asking xapian for an estimated count of
-        each sub-query.
+        """Count the documents matching the query for each value of
+        the facet prefix *prefix*, see `facets`.
+
+        Returns a dictionary of facet, as written in a query, to count.
+        """
+        return self.facets(query, [prefix],
+                           estimate=estimate,
+                           language=language,
+                           limit=limit,
+                           mlimit=mlimit,
+                           klimit=klimit,
+                           kmlimit=kmlimit,
+                           echo=echo,
+                           retry_limit=retry_limit,
+                           include_query_terms=include_query_terms)[prefix]
+
+    @reconnector
+    def facets(self, query,
+               prefixes=('facet',),
+               estimate=True,
+               language=None,
+               limit=0,
+               mlimit=0,
+               klimit=1.0,
+               kmlimit=1.0,
+               echo=False,
+               retry_limit=RETRY_LIMIT,
+               include_query_terms=True,
+               values=()):
+        """Count the values of several facet prefixes, and of value
+        slots, in the documents matching the query, in a single match.
+
+        The terms of each prefix are counted by a TermCountMatchSpy,
+        and each value by a xapian.ValueCountMatchSpy, while xapian
+        matches the query.
+
+        :param prefixes: The facet prefixes to count.
+
+        :param estimate: If True, only *mlimit* matching documents are
+        examined and the counts are scaled up to the estimated number
+        of matches.  If False, all matches are examined and the
+        counts are exact.  Default: True
+
+        :param limit: The number of values to return per prefix, the
+        most frequent first.  If 0, the limit is the number of
+        documents times *klimit*.
+
+        :param mlimit: The number of matching documents to examine
+        when estimating.  If 0, the number of documents times
+        *kmlimit*.
+
+        :param include_query_terms: If False, values used in the query
+        itself are left out.
+
+        :param values: Sortable values to facet on.  Each item is a
+        value name, to count its *limit* most frequent values, or a
+        (name, bucket) pair to count values in buckets: a width for
+        integer values, or 'day', 'month' or 'year' for date and
+        datetime values.
+
+        Returns a dictionary of prefix, or item of *values*, to a
+        dictionary of facet, as written in a query, to count.  Integer,
+        date and datetime facets are written as the value ranges that
+        match them, and bucketed ones are OrderedDicts in value order.
+        Value ranges can not express every string, so string and
+        boolean facets are written as name:value terms; they only match
+        the same documents if the value is also indexed as a boolean
+        term under its name.
+
+        For the empty query, term facets are counted over the whole
+        database from term frequencies, cached until the database
+        changes, without running a match.  Value facets of the empty
+        query are counted by one match per database revision.  On remote backends, which
+        can not run python match spies, each prefix's facets are
+        suggested for the query and counted one query at a time.
         """
+        self.maybe_reopen()
+        value_specs = []
+        for spec in values:
+            name, bucket = spec if isinstance(spec, tuple) else (spec, None)
+            if spec in prefixes:
+                raise ValueError("%s is both a prefix and a value" % spec)
+            if name not in self.values:
+                raise ValueError("There is no value %s" % name)
+            value_specs.append((spec, name, bucket, self.values[name],
+                                self.value_sorts.get(name)))
+
+        doccount = self.backend.get_doccount()
+        if limit == 0:
+            limit = int(doccount * klimit)
+        if query == "":
+            results = {}
+            if value_specs:
+                # value facets need a match, run once per revision
+                cache = self._global_cache()
+                key = ('values', tuple(values), limit, estimate, mlimit,
+                       kmlimit)
+                if key not in cache:
+                    cache[key] = self.facets(
+                        Query(""), (), estimate=estimate, limit=limit,
+                        mlimit=mlimit, kmlimit=kmlimit,
+                        retry_limit=retry_limit, values=values)
+                results = deepcopy(cache[key])
+            for prefix in prefixes:
+                results[prefix] = dict(
+                    (_format_term(prefix, term.decode('utf8')), count)
+                    for term, count in
+                    self._global_facets(prefix, retry_limit)[:limit])
+            return results
+
+        query = self.querify(query, language=language)
+        if self.remote and prefixes:
+            # count values in a match, and terms the old way
+            results = {}
+            if values:
+                results = self.facets(query, (), estimate=estimate,
+                                      limit=limit, mlimit=mlimit,
+                                      kmlimit=kmlimit, echo=echo,
+                                      retry_limit=retry_limit, values=values)
+            for prefix in prefixes:
+                results[prefix] = self._suggest_facets(
+                    query, prefix, estimate, language, limit, mlimit,
+                    klimit, kmlimit, echo, retry_limit, include_query_terms)
+            return results
+        if echo:
+            print str(query)
+        enq = xapian.Enquire(self.backend)
+        enq.set_query(query)
+
+        check = doccount
         if estimate:
-            counter = self.estimate
+            check = mlimit or int(doccount * kmlimit)
+
+        def op():
+            # fresh spies, in case the match is retried
+            enq.clear_matchspies()
+            spies = [xapian.ValueCountMatchSpy(spec[3])
+                     for spec in value_specs]
+            spy = None
+            if prefixes:
+                spy = TermCountMatchSpy([_prefix(p) for p in prefixes])
+                enq.add_matchspy(spy)
+            for value_spy in spies:
+                enq.add_matchspy(value_spy)
+            return enq.get_mset(0, 0, check), spy, spies
+        mset, spy, spies = self.retry_if_modified(op, retry_limit)
+
+        scale = 1.0
+        matches = mset.get_matches_estimated()
+        if spy is not None:
+            seen = spy.total
+        elif spies:
+            seen = spies[0].get_total()
         else:
-            counter = self.count
+            seen = matches
+        if estimate and seen and seen < matches:
+            scale = float(matches) / seen
 
         results = {}
-        query = self.querify(query, language=language)
-
-        suggestions = self.suggest(query,
-                                   prefix=prefix,
-                                   language=language,
-                                   limit=limit,
-                                   mlimit=mlimit,
-                                   klimit=klimit,
-                                   kmlimit=kmlimit,
-                                   echo=echo,
-                                   retry_limit=retry_limit,
-                                   format_term=False,
-                                   include_query_terms=include_query_terms)
-        for facet in suggestions:
-            q = Query(Query.OP_AND, [query, facet])
-            if echo:
-                print str(q)
-            if prefix and facet.startswith('X%s:' % prefix.upper()):
-                suffix = facet[len(prefix) + 2:]
-                if ' ' in suffix or '..' in suffix:
-                    facet = '%s:"%s"' % (prefix, suffix)
-                else:
-                    facet = '%s:%s' % (prefix, suffix)
-            results[facet] = counter(q, language=language)
+        for (spec, name, bucket, slot, sort), value_spy in zip(value_specs,
+                                                                spies):
+            counts = [(item.term, item.termfreq)
+                      for item in value_spy.values()]
+            if bucket is not None:
+                facets = _value_buckets(name, sort, bucket, counts)
+            else:
+                counts.sort(key=itemgetter(1), reverse=True)
+                facets = {}
+                for raw, count in counts[:limit]:
+                    if sort == 'integer':
+                        raw = _decode_integer(raw)
+                    elif sort not in _value_widths:
+                        facets[_format_facet(name, raw.decode('utf8'))] = (
+                            count)
+                        continue
+                    facets['%s:%s..%s' % (name, raw, raw)] = count
+            for key in facets:
+                facets[key] = int(round(facets[key] * scale))
+            results[spec] = facets
+        if spy is None:
+            return results
+
+        skip = set()
+        if not include_query_terms:
+            skip.update(query)
+        for prefix in prefixes:
+            results[prefix] = {}
+        by_prefix = dict((_prefix(p), p) for p in prefixes)
+        counts = sorted(spy.counts.items(), key=itemgetter(1), reverse=True)
+        for term, count in counts:
+            if term in skip:
+                continue
+            prefix = by_prefix[term[:term.index(':') + 1]]
+            facets = results[prefix]
+            if len(facets) < limit:
+                facets[_format_term(prefix, term.decode('utf8'))] = (
+                    int(round(count * scale)))
         return results
 
     @reconnector
@@ -1085,40 +2447,139 @@ class Database(object):
                include_query_terms=True):
         """
         Expand a query on a given set of prefixes.
-        """
 
+        Each item of *expand* is a facet prefix, or a (prefix, limit,
+        mlimit, klimit, kmlimit) tuple, see `facets`.  The first prefix
+        is counted in the documents matching the query, and each
+        following prefix in the documents that also have the value
+        of the previous level.  All levels are counted by one
+        PivotMatchSpy in a single match; the sampling of the match is
+        set by the first level's mlimit and kmlimit.
+
+        Returns an OrderedDict of facet to count, the most frequent
+        first.  Above the last level, the counts are (count, OrderedDict)
+        pairs that hold the next level.
+
+        The expansion of the empty query is cached until the database
+        changes.  On remote backends each level is faceted separately
+        for every facet of the previous level.
+        """
+        self.maybe_reopen()
         q = self.querify(query, language, translit, default_op, parser_flags,
                          retry_limit=retry_limit)
         if echo:
             print q
+        levels = [defaults(*(head if isinstance(head, tuple) else (head,)))
+                  for head in expand]
+        if query == "":
+            cache = self._global_cache()
+            key = ('expand', tuple(levels))
+            if key not in cache:
+                cache[key] = self.expand(q, expand, retry_limit=retry_limit)
+            return deepcopy(cache[key])
+        if self.remote:
+            return self._expand_by_facets(q, levels, language, echo,
+                                          retry_limit, include_query_terms)
+        enq = xapian.Enquire(self.backend)
+        enq.set_query(q)
+        spy = PivotMatchSpy([_prefix(level[0]) for level in levels])
+        enq.add_matchspy(spy)
+
+        doccount = self.backend.get_doccount()
+        mlimit, kmlimit = levels[0][2], levels[0][4]
+        check = mlimit or int(doccount * kmlimit)
+
+        def op():
+            spy.clear()
+            return enq.get_mset(0, 0, check)
+        mset = self.retry_if_modified(op, retry_limit)
+
+        scale = 1.0
+        matches = mset.get_matches_estimated()
+        if spy.total and spy.total < matches:
+            scale = float(matches) / spy.total
+        skip = set()
+        if not include_query_terms:
+            skip.update(q)
+
+        def build(node, depth):
+            prefix, limit, mlimit, klimit, kmlimit = levels[depth]
+            limit = limit or int(doccount * klimit)
+            counts = sorted(((term, entry) for term, entry in node.iteritems()
+                             if term not in skip),
+                            key=lambda i: i[1][0], reverse=True)
+            results = {}
+            for term, (count, children) in counts[:limit]:
+                name = _format_term(prefix, term.decode('utf8'))
+                score = int(round(count * scale))
+                if depth + 1 < len(levels):
+                    results[name] = (score, build(children, depth + 1))
+                else:
+                    results[name] = score
+            return OrderedDict(sorted(results.items(), key=lambda i: i[1],
+                                      reverse=True))
+
+        return build(spy.root, 0)
+
+    def _expand_by_facets(self, q, levels, language, echo, retry_limit,
+                          include_query_terms):
+        """Expand a query one level at a time, faceting the query with
+        each facet of the previous level.  Used for remote backends,
+        which can not run a PivotMatchSpy."""
+        prefix, limit, mlimit, klimit, kmlimit = levels[0]
+        counts = self.facet(q, prefix=prefix, language=language, echo=echo,
+                            limit=limit, mlimit=mlimit,
+                            klimit=klimit, kmlimit=kmlimit,
+                            retry_limit=retry_limit,
+                            include_query_terms=include_query_terms)
         results = {}
-        head, tail = expand[0], expand[1:]
-        if isinstance(head, tuple):
-            args = head
-        else:
-            args = (head,)
-        head, limit, mlimit, klimit, kmlimit = defaults(*args)
-
-        r = self.facet(
-            q, prefix=head, language=language, echo=echo,
-            limit=limit, mlimit=mlimit,
-            klimit=klimit, kmlimit=kmlimit,
-            retry_limit=retry_limit,
-            include_query_terms=include_query_terms).items()
-
-        for name, score in r:
-            if tail:
+        for name, count in counts.iteritems():
+            if len(levels) > 1:
                 subq = self.querify([q, name], retry_limit=retry_limit)
                 if echo:
                     print subq
-                r = self.expand(
-                    subq, tail, language, echo,
-                    default_op, parser_flags,
-                    retry_limit=retry_limit)
-                results[name] = (score, r)
+                results[name] = (count, self._expand_by_facets(
+                    subq, levels[1:], language, echo, retry_limit,
+                    include_query_terms))
             else:
-                results[name] = score
-        return OrderedDict(sorted(results.items(), key=lambda i: i[1], reverse=True))
+                results[name] = count
+        return OrderedDict(sorted(results.items(), key=lambda i: i[1],
+                                  reverse=True))
+
+    def _suggest_facets(self, query, prefix, estimate, language, limit,
+                        mlimit, klimit, kmlimit, echo, retry_limit,
+                        include_query_terms):
+        """Get facet suggestions for the query, then the query with
+        each suggested facet, asking xapian for an estimated count of
+        each sub-query.  Used for remote backends, which can not run a
+        TermCountMatchSpy.
+        """
+        if estimate:
+            counter = self.estimate
+        else:
+            counter = self.count
+
+        results = {}
+        suggestions = self.suggest(query,
+                                   prefix=prefix,
+                                   language=language,
+                                   limit=limit,
+                                   mlimit=mlimit,
+                                   klimit=klimit,
+                                   kmlimit=kmlimit,
+                                   echo=echo,
+                                   retry_limit=retry_limit,
+                                   format_term=False,
+                                   include_query_terms=include_query_terms,
+                                   rset_limit=0)
+        for facet in suggestions:
+            q = Query(Query.OP_AND, [query, facet])
+            if echo:
+                print str(q)
+            if prefix and facet.startswith('X%s:' % prefix.upper()):
+                facet = _format_term(prefix, facet)
+            results[facet] = counter(q, language=language)
+        return results
 
     @reconnector
     def estimate(self, query,
@@ -1135,7 +2596,7 @@ class Database(object):
         Limit tells the estimator the minimum number of documents to
         consider.  A zero limit means potentially check all documents
         in the db."""
-        self.reopen()
+        self.maybe_reopen()
         enq = xapian.Enquire(self.backend)
 
         if limit == 0:
@@ -1157,7 +2618,7 @@ class Database(object):
         Return a count of the number of documents indexed for a given
         term.  Useful for testing.
         """
-        self.reopen()
+        self.maybe_reopen()
         return self.backend.get_termfreq(term)
 
     @reconnector
@@ -1168,11 +2629,11 @@ class Database(object):
         """
         Describe the parsed query.
         """
-        qp = self.get_query_parser(language, default_op,
-                                   retry_limit=RETRY_LIMIT)
-        def op():
-            return qp.parse_query(query, default_parser_flags)
-        return str(self.retry_if_modified(op, retry_limit))
+        with self.query_parser(language, default_op, retry_limit) as qp:
+            def op():
+                qp.set_database(self.backend)
+                return qp.parse_query(query, default_parser_flags)
+            return str(self.retry_if_modified(op, retry_limit))
 
     @reconnector
     def spell(self, query,
@@ -1182,13 +2643,13 @@ class Database(object):
         """
         Suggest a query string with corrected spelling.
         """
-        self.reopen()
-        qp = self.get_query_parser(language, default_op,
-                                   retry_limit=RETRY_LIMIT)
-        def op():
-            qp.parse_query(query, QueryParser.FLAG_SPELLING_CORRECTION)
-            return qp.get_corrected_query_string().decode('utf8')
-        return self.retry_if_modified(op, retry_limit)
+        self.maybe_reopen()
+        with self.query_parser(language, default_op, retry_limit) as qp:
+            def op():
+                qp.set_database(self.backend)
+                qp.parse_query(query, QueryParser.FLAG_SPELLING_CORRECTION)
+                return qp.get_corrected_query_string().decode('utf8')
+            return self.retry_if_modified(op, retry_limit)
 
     @reconnector
     def suggest(self, query,
@@ -1209,18 +2670,28 @@ class Database(object):
                 retry_limit=RETRY_LIMIT,
                 format_term=True,
                 collapse_stems=True,
-                include_query_terms=True):
+                include_query_terms=True,
+                rset_limit=None):
         """
         Suggest terms that would possibly yield more relevant results
         for the given query.
+
+        Terms are drawn from the top documents of the query.  Unless
+        *mlimit* is given, at most *rset_limit* documents are used,
+        `suggest_rset_limit` by default, or all matching documents if
+        it is 0.
         """
-        self.reopen()
+        self.maybe_reopen()
         enq = xapian.Enquire(self.backend)
 
         query = self.querify(query, language, translit, default_op, parser_flags)
 
+        if rset_limit is None:
+            rset_limit = self.suggest_rset_limit
         if mlimit == 0:
             mlimit = int(self.backend.get_doccount() * kmlimit)
+            if rset_limit:
+                mlimit = min(mlimit, rset_limit)
 
         if echo:
             print str(query)
@@ -1264,11 +2735,7 @@ class Database(object):
         for item in eset.items:
             val = item[0].decode('utf8')
             if format_term and prefix and val.startswith('X%s:' % prefix.upper()):
-                suffix = val[len(prefix) + 2:]
-                if ' ' in suffix or '..' in suffix:
-                    val = '%s:"%s"' % (prefix, suffix)
-                else:
-                    val = '%s:%s' % (prefix, suffix)
+                val = _format_term(prefix, val)
             if collapse_stems:
                 if stemmer(val) in stems:
                     continue
@@ -1347,6 +2814,10 @@ class JSONDatabase(object):
     def facet(self, *args, **kw):
         return self._database.facet(*args, **kw)
 
+    @jsonrpc_wrapper
+    def facets(self, *args, **kw):
+        return self._database.facets(*args, **kw)
+
     @jsonrpc_wrapper
     def expand(self, *args, **kw):
         return self._database.expand(*args, **kw)
@@ -2,6 +2,7 @@ import logging
 import unicodedata
 import translitcodec
 import cPickle
+from collections import namedtuple
 
 import nilsimsa
 from flatland import schema
@@ -39,6 +40,117 @@ def _normalize(value, lower=True):
 _use_schema = object() # marker says use schema term generator
 
 
+_IndexStep = namedtuple('_IndexStep', ['handler',
+                                       'index',
+                                       'store',
+                                       'facet',
+                                       'prefix',
+                                       'boolean',
+                                       'lower',
+                                       'wdf_inc',
+                                       'sortable'])
+
+_index_steps = {}
+
+
+def _index_step(element_cls):
+    """Return the indexing step for an element class.
+
+    The step holds the name of the Schema method that handles the
+    element and the element's indexing flags.  It is computed once per
+    element class and cached, so memo generation does no per-element
+    type dispatch.
+    """
+    try:
+        return _index_steps[element_cls]
+    except KeyError:
+        pass
+    for base, handler in _handlers:
+        if issubclass(element_cls, base):
+            break
+    else:
+        handler = None
+    step = _IndexStep(handler,
+                      element_cls.index,
+                      element_cls.store,
+                      element_cls.facet,
+                      element_cls.prefix,
+                      element_cls.boolean,
+                      element_cls.lower,
+                      element_cls.wdf_inc,
+                      element_cls.sortable)
+    _index_steps[element_cls] = step
+    return step
+
+
+_declared_index = {}
+
+_scalar_fields = {}
+
+_sorts = {
+    '_handle_string': 'string',
+    '_handle_integer': 'integer',
+    '_handle_boolean': 'boolean',
+    '_handle_date': 'date',
+    '_handle_datetime': 'datetime',
+    }
+
+
+def _custom_value(field, handler):
+    """True if a sortable element stores its value differently from
+    the default element of its sort."""
+    if handler == '_handle_date':
+        return field.value_format != Date.value_format
+    if handler == '_handle_datetime':
+        return field.value_format != DateTime.value_format
+    if handler == '_handle_location':
+        return bool(field.radians)
+    return False
+
+
+def _declare_fields(schema_cls, fields, path, terms, texts, values, custom):
+    """Walk element classes the way Schema handlers walk elements,
+    collecting the prefixes and values they would generate, and the
+    names of values stored in a custom format."""
+    for field in fields:
+        step = _index_step(field)
+        if not step.index:
+            continue
+        fpath = path + [field.name] if field.name else path
+        name = '_'.join(fpath)
+        typ = 'b' if step.boolean else 'r'
+        if step.handler in _sorts:
+            if step.prefix:
+                # _handle_scalar lowercases the whole prefixed term
+                terms.append((_normalize(name) if step.lower else name, typ))
+            if step.sortable:
+                values.append((name, _sorts[step.handler]))
+                if _custom_value(field, step.handler):
+                    custom.append(name)
+        elif step.handler == '_handle_text':
+            if field.string and field.string_prefix:
+                terms.append((field.string_prefix, typ))
+            if step.sortable:
+                values.append((name, 'string'))
+            if step.prefix:
+                texts.append((name, None))
+        elif step.handler == '_handle_numericrange':
+            terms.append((field.name, 'b'))
+        elif step.handler == '_handle_location':
+            if step.sortable:
+                values.append((field.name, 'location'))
+                if _custom_value(field, step.handler):
+                    custom.append(field.name)
+        elif issubclass(field, Dict):
+            _declare_fields(schema_cls, field.field_schema,
+                            fpath, terms, texts, values, custom)
+        elif issubclass(field, Array):
+            _declare_fields(schema_cls, [field.member_schema],
+                            fpath, terms, texts, values, custom)
+        if step.facet and field.name:
+            terms.append((schema_cls.facet_prefix, 'b'))
+
+
 class SparseForm(schema.SparseDict):
     __metaclass__ = _MetaForm
 
@@ -68,6 +180,13 @@ class Schema(SparseForm):
     When False (default) an invalid term in a document raises InvalidTermError.
     """
 
+    unique_key = None
+    """The name of an element whose value uniquely identifies the
+    document.  If set, the key is indexed as a reserved boolean term
+    so that the document can be replaced or deleted by key, see
+    :meth:`Database.upsert`.
+    """
+
     __xodb_db__ = None
 
     def update_by_object(self, obj):
@@ -94,6 +213,61 @@ class Schema(SparseForm):
             else:
                 self[name] = value
 
+    @classmethod
+    def declared_index(cls):
+        """Return the prefixes and sortable values this schema's
+        elements generate, as a (prefixes, values) tuple.
+
+        prefixes is a list of (name, type) pairs, where type is the
+        memo term type ('b' or 'r') for term prefixes and None for
+        text prefixes.  values is a list of (name, sort) pairs.
+
+        Elements whose names depend on the data, like List members,
+        are not included.
+        """
+        return cls._declare()[:2]
+
+    @classmethod
+    def custom_values(cls):
+        """Return the names of the sortable values this schema's
+        elements store in a format other than the default for their
+        sort, like dates with a custom value_format or locations in
+        radians.  They can not be decoded without their element.
+        """
+        return cls._declare()[2]
+
+    @classmethod
+    def _declare(cls):
+        declared = _declared_index.get(cls)
+        if declared is None:
+            terms, texts, values, custom = [], [], [], []
+            _declare_fields(cls, cls.field_schema, [], terms, texts, values,
+                            custom)
+            declared = (terms + texts, values, custom)
+            _declared_index[cls] = declared
+        return declared
+
+    @classmethod
+    def scalar_fields(cls):
+        """Return a dict mapping the names of this schema's fields to
+        their element classes for fields that flatten to a single
+        value, and to None for container fields.
+
+        The dict is empty for named schemas, whose flattened names
+        carry the schema's name.
+        """
+        fields = _scalar_fields.get(cls)
+        if fields is None:
+            fields = {}
+            if cls.name is None:
+                for field in cls.field_schema:
+                    # compounds, like locations, flatten to their parts
+                    fields[field.name] = (
+                        field if issubclass(field, schema.Scalar) and
+                        not issubclass(field, schema.Compound) else None)
+            _scalar_fields[cls] = fields
+        return fields
+
     @property
     def __xodb_memo__(self):
         """
@@ -109,43 +283,29 @@ class Schema(SparseForm):
 
         self._memo = Memo()
         self._memo.set_lang(lang)
+        if self.unique_key is not None:
+            # update_by_object removes optional elements without a value
+            key = self.get(self.unique_key)
+            self._memo.set_key(key.value if key is not None else None)
         self._handle_children(self, None)
         self._memo.data = dumps((_schema_name(self), self.flatten()))
         return self._memo
 
     def _handle_children(self, parent, grandparent):
+        memo = self._memo
+        root = parent is self and self.name is None
         for el in parent.children:
-            if el.index:
-                if isinstance(el, String):
-                    handler = self._handle_string
-                elif isinstance(el, Integer):
-                    handler = self._handle_integer
-                elif isinstance(el, Float):
-                    handler = self._handle_float
-                elif isinstance(el, Boolean):
-                    handler = self._handle_boolean
-                elif isinstance(el, Date):
-                    handler = self._handle_date
-                elif isinstance(el, DateTime):
-                    handler = self._handle_datetime
-                elif isinstance(el, Text):
-                    handler = self._handle_text
-                elif isinstance(el, NumericRange):
-                    handler = self._handle_numericrange
-                elif isinstance(el, Location):
-                    handler = self._handle_location
-                elif isinstance(el, List):
-                    handler = self._handle_children
-                elif isinstance(el, Dict):
-                    handler = self._handle_children
-                elif isinstance(el, Array):
-                    handler = self._handle_children
-                else:
+            step = _index_step(type(el))
+            if step.index:
+                if step.handler is None:
                     raise TypeError("Unknown element %s" % el)
+                # children of an unnamed root flatten to their own name
+                name = el.name if root else el.flattened_name()
 
                 value = None
                 try:
-                    value = handler(el, parent)
+                    value = getattr(self, step.handler)(el, parent,
+                                                        step, name)
                 except InvalidTermError:
                     if self.ignore_invalid_terms:
                         logger.warning('Invalid term ignored: %r' % el)
@@ -153,68 +313,69 @@ class Schema(SparseForm):
                         raise
 
                 if value is not None:
-                    if el.facet:
+                    if step.facet:
                         if el.name:
                             term = el.name.lower()
-                            self._memo.add_term(
+                            memo.add_term(
                                 _prefix(self.facet_prefix, term),
                                 True)
-            if not el.store:
+            if not step.store:
                 el.value = None
         return True
 
-    def _handle_scalar(self, term, value, element, type=None):
-        name = element.flattened_name()
+    def _handle_container(self, element, parent, step, name):
+        return self._handle_children(element, parent)
+
+    def _handle_scalar(self, term, value, step, name, type=None):
         memo = self._memo
         if term:
-            if element.prefix:
-                prefixed = _normalize(_prefix(name, term), lower=element.lower)
-                memo.add_term(prefixed, element.boolean, element.wdf_inc)
+            if step.prefix:
+                prefixed = _normalize(_prefix(name, term), lower=step.lower)
+                memo.add_term(prefixed, step.boolean, step.wdf_inc)
             else:
-                term = _normalize(term, lower=element.lower)
-                memo.add_term(term, element.boolean, element.wdf_inc)
-            if element.sortable:
+                term = _normalize(term, lower=step.lower)
+                memo.add_term(term, step.boolean, step.wdf_inc)
+            if step.sortable:
                 memo.add_value(name, value, type)
             return value
 
-    def _handle_string(self, element, parent):
+    def _handle_string(self, element, parent, step, name):
         term = element.u
         value = element.value
         if value:
-            return self._handle_scalar(term, value, element, 'string')
+            return self._handle_scalar(term, value, step, name, 'string')
 
-    def _handle_integer(self, element, parent):
+    def _handle_integer(self, element, parent, step, name):
         term = element.u
         value = element.value
         if value:
-            return self._handle_scalar(term, value, element, 'integer')
+            return self._handle_scalar(term, value, step, name, 'integer')
 
-    def _handle_float(self, element, parent):
+    def _handle_float(self, element, parent, step, name):
         # TODO:mp floats are currently storage only
         pass
 
-    def _handle_boolean(self, element, parent):
+    def _handle_boolean(self, element, parent, step, name):
         value = 'true' if element.value else 'false'
         if value:
-            return self._handle_scalar(value, value, element, 'integer')
+            return self._handle_scalar(value, value, step, name, 'boolean')
 
-    def _handle_date(self, element, parent):
+    def _handle_date(self, element, parent, step, name):
         if element.value:
             term = element.value.strftime(element.term_format)
             value = element.value.strftime(element.value_format)
-            return self._handle_scalar(term, value, element, 'date')
+            return self._handle_scalar(term, value, step, name, 'date')
 
-    def _handle_datetime(self, element, parent):
+    def _handle_datetime(self, element, parent, step, name):
         if element.value:
             term = element.value.strftime(element.term_format)
             value = element.value.strftime(element.value_format)
-            return self._handle_scalar(term, value, element, 'datetime')
+            return self._handle_scalar(term, value, step, name, 'datetime')
 
-    def _handle_text(self, element, parent):
+    def _handle_text(self, element, parent, step, name):
         value = element.value
         if value is None:
             return
-        name = element.flattened_name()
         memo = self._memo
 
         if element.language is _use_schema:
@@ -227,31 +388,31 @@ class Schema(SparseForm):
 
         if element.string:
             if value:
-                if element.lower:
+                if step.lower:
                     term = value.lower()
                 if element.string_prefix:
                     memo.add_term(_prefix(element.string_prefix, term),
-                                   element.boolean, element.wdf_inc)
+                                   step.boolean, step.wdf_inc)
                 else:
-                    memo.add_term(term, False, element.wdf_inc)
+                    memo.add_term(term, False, step.wdf_inc)
 
-        if element.sortable:
+        if step.sortable:
             memo.add_value(name, value, 'string')
 
         value = _normalize(value)
         prefix = None
-        if element.prefix:
+        if step.prefix:
             prefix = _prefix(name)
         memo.add_text(value, prefix, lang,
                       element.positions,
                       element.stem,
                       element.stop,
                       element.spelling,
-                      element.wdf_inc,
+                      step.wdf_inc,
                       element.position_start)
         return value
 
-    def _handle_numericrange(self, element, parent):
+    def _handle_numericrange(self, element, parent, step, name):
         maxv = element['high'].value or 0
         minv = element['low'].value or 0
         if minv == maxv == 0:
@@ -273,11 +434,11 @@ class Schema(SparseForm):
                                 element.wdf_inc)
         return True
 
-    def _handle_location(self, element, parent):
+    def _handle_location(self, element, parent, step, name):
         memo = self._memo
         h = 'loc_' + element.hash(element.radians)
-        memo.add_term(h, element.boolean, element.wdf_inc)
-        if element.sortable:
+        memo.add_term(h, step.boolean, step.wdf_inc)
+        if step.sortable:
             memo.add_value(element.name, h, 'location')
         return True
 
@@ -545,3 +706,18 @@ class Location(schema.Compound, _BaseElement):
         return geoprint.encode(lat, lon, radians=radians)
 
 
+# Schema handler for each element type, in order of precedence.
+_handlers = (
+    (String, '_handle_string'),
+    (Integer, '_handle_integer'),
+    (Float, '_handle_float'),
+    (Boolean, '_handle_boolean'),
+    (Date, '_handle_date'),
+    (DateTime, '_handle_datetime'),
+    (Text, '_handle_text'),
+    (NumericRange, '_handle_numericrange'),
+    (Location, '_handle_location'),
+    (List, '_handle_container'),
+    (Dict, '_handle_container'),
+    (Array, '_handle_container'),
+    )
@@ -16,9 +16,17 @@ class AttributeTypeRequired(XODBError):
     pass
 
 
+class UniqueKeyRequired(XODBError):
+    pass
+
+
 class ValidationError(XODBError):
     pass
 
 
 class PrefixError(XODBError):
     pass
+
+
+class MemoFormatError(XODBError):
+    pass
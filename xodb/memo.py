@@ -1,8 +1,208 @@
-
+import struct
+import hashlib
 
 MAX_TERM_LEN = 240 # compile time xapian limit
 
-from .exc import InvalidTermError
+from .exc import InvalidTermError, MemoFormatError
+
+MEMO_MAGIC = 'XM'
+MEMO_VERSION = 2
+
+# type tags of the binary memo format
+(_NONE, _TRUE, _FALSE, _INT, _FLOAT,
+ _BYTES, _UNICODE, _TUPLE, _REF) = [chr(i) for i in range(9)]
+
+_double = struct.Struct('<d')
+
+
+def _varint(n):
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+
+class _Encoder(object):
+    """Writes the body of a binary memo, interning prefixes, names,
+    types and languages into a string table."""
+
+    def __init__(self):
+        self.out = []
+        self.table = {}
+        self.strings = []
+
+    def value(self, v):
+        out = self.out
+        if v is None:
+            out.append(_NONE)
+        elif v is True:
+            out.append(_TRUE)
+        elif v is False:
+            out.append(_FALSE)
+        elif isinstance(v, (int, long)):
+            # zigzag encode so small negative numbers stay small
+            out.append(_INT + _varint(v * 2 if v >= 0 else -v * 2 - 1))
+        elif isinstance(v, float):
+            out.append(_FLOAT + _double.pack(v))
+        elif isinstance(v, str):
+            out.append(_BYTES + _varint(len(v)) + v)
+        elif isinstance(v, unicode):
+            v = v.encode('utf-8')
+            out.append(_UNICODE + _varint(len(v)) + v)
+        elif isinstance(v, (tuple, list)):
+            out.append(_TUPLE + _varint(len(v)))
+            for i in v:
+                self.value(i)
+        else:
+            raise MemoFormatError("Cannot encode %r in a memo" % (v,))
+
+    def ref(self, s):
+        if not isinstance(s, basestring):
+            return self.value(s)
+        key = (type(s), s)
+        index = self.table.get(key)
+        if index is None:
+            index = self.table[key] = len(self.strings)
+            self.strings.append(s)
+        self.out.append(_REF + _varint(index))
+
+    def term(self, term):
+        prefix, sep, rest = term.partition(':')
+        if sep:
+            self.ref(prefix)
+            self.value(rest)
+        else:
+            self.out.append(_NONE)
+            self.value(term)
+
+    def terms(self, terms):
+        self.out.append(_varint(len(terms)))
+        for t in terms:
+            self.out.append(_varint(len(t)))
+            self.term(t[0])
+            for i in t[1:]:
+                self.ref(i)
+
+    def encode(self, memo):
+        self.ref(memo.lang)
+        self.value(memo.key)
+        self.terms(memo.terms)
+        self.terms(memo.posts)
+        self.out.append(_varint(len(memo.texts)))
+        for text in memo.texts:
+            self.out.append(_varint(len(text)))
+            for key in sorted(text):
+                self.ref(key)
+                if key == 'text':
+                    self.value(text[key])
+                else:
+                    self.ref(text[key])
+        self.out.append(_varint(len(memo.values)))
+        for name, value, typ in memo.values:
+            self.ref(name)
+            self.value(value)
+            self.ref(typ)
+        self.value(memo.data)
+
+        header = [MEMO_MAGIC, chr(MEMO_VERSION), _varint(len(self.strings))]
+        body = self.out
+        self.out = header
+        for s in self.strings:
+            self.value(s)
+        return ''.join(header + body)
+
+
+class _Decoder(object):
+    """Reads a binary memo written by _Encoder."""
+
+    def __init__(self, data):
+        if data[:2] != MEMO_MAGIC or len(data) < 3:
+            raise MemoFormatError("Not a binary memo")
+        if ord(data[2]) > MEMO_VERSION:
+            raise MemoFormatError(
+                "Unsupported memo version %s" % ord(data[2]))
+        self.data = data
+        self.version = ord(data[2])
+        self.pos = 3
+        self.table = []
+
+    def varint(self):
+        data = self.data
+        n = shift = 0
+        while True:
+            b = ord(data[self.pos])
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def chunk(self, size):
+        start = self.pos
+        self.pos += size
+        if self.pos > len(self.data):
+            raise MemoFormatError("Truncated memo")
+        return self.data[start:self.pos]
+
+    def value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == _REF:
+            return self.table[self.varint()]
+        elif tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            n = self.varint()
+            return n >> 1 if not n & 1 else -(n >> 1) - 1
+        elif tag == _FLOAT:
+            return _double.unpack(self.chunk(8))[0]
+        elif tag in (_BYTES, _UNICODE):
+            v = self.chunk(self.varint())
+            return v if tag == _BYTES else v.decode('utf-8')
+        elif tag == _TUPLE:
+            return tuple(self.value() for i in xrange(self.varint()))
+        raise MemoFormatError("Unknown memo type tag %r" % tag)
+
+    def term(self):
+        prefix = self.value()
+        rest = self.value()
+        return rest if prefix is None else prefix + ':' + rest
+
+    def terms(self):
+        terms = []
+        for i in xrange(self.varint()):
+            size = self.varint()
+            term = [self.term()]
+            for j in xrange(size - 1):
+                term.append(self.value())
+            terms.append(tuple(term))
+        return terms
+
+    def decode(self, memo):
+        try:
+            self.table = [self.value() for i in xrange(self.varint())]
+            memo.lang = self.value()
+            if self.version > 1:
+                memo.key = self.value()
+            memo.terms = self.terms()
+            memo.posts = self.terms()
+            memo.texts = [dict((self.value(), self.value())
+                               for j in xrange(self.varint()))
+                          for i in xrange(self.varint())]
+            memo.values = [(self.value(), self.value(), self.value())
+                           for i in xrange(self.varint())]
+            memo.data = self.value()
+        except IndexError:
+            raise MemoFormatError("Truncated memo")
+        if self.pos != len(self.data):
+            raise MemoFormatError("Trailing data after memo")
+        return memo
 
 
 class Memo(object):
@@ -11,6 +211,7 @@ class Memo(object):
 
     def __init__(self):
         self.lang = None
+        self.key = None    # unique key of the document, or None
         self.terms = []    # (term, type) | (term, type, wdfinc)
         self.posts = []    # (term, position) | (term, position, wdfinc)
         self.texts = []    # {text=u"", lang=None, stem=True, stop=True,
@@ -23,6 +224,7 @@ class Memo(object):
         """ Construct a Memo from a data dictionary. """
         m = cls()
         m.lang = data.get('lang')
+        m.key = data.get('key')
         m.terms = data.get('terms', [])
         m.posts = data.get('posts', [])
         m.texts = data.get('texts', [])
@@ -35,6 +237,7 @@ class Memo(object):
         """ Returns a dictionary representation of the document. """
         return dict(
             lang=self.lang,
+            key=self.key,
             terms=self.terms,
             posts=self.posts,
             texts=self.texts,
@@ -74,3 +277,70 @@ class Memo(object):
 
     def set_lang(self, lang):
         self.lang = lang
+
+    def set_key(self, key):
+        self.key = key
+
+    def to_bytes(self):
+        """ Returns the memo in the compact binary memo format.
+
+        The format is versioned and independent of python's pickle
+        protocol, for storing and exchanging memos.  It is not faster
+        than cPickle, which remains the transport between processes.
+        """
+        return _Encoder().encode(self)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Construct a Memo from the binary memo format. """
+        return _Decoder(data).decode(cls())
+
+    def fingerprint(self):
+        """ Returns a digest of the memo's content, equal for memos
+        that produce the same document. """
+        return hashlib.sha1(self.to_bytes()).digest()
+
+
+class MemoWriter(object):
+    """ Writes a stream of memos to a file-like object in the binary
+    memo format, each prefixed with its length. """
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, memo):
+        data = memo.to_bytes()
+        self.file.write(_varint(len(data)) + data)
+
+    def write_all(self, memos):
+        for memo in memos:
+            self.write(memo)
+
+
+class MemoReader(object):
+    """ Iterates over the memos in a file-like object written by a
+    MemoWriter. """
+
+    def __init__(self, file, memo_class=Memo):
+        self.file = file
+        self.memo_class = memo_class
+
+    def __iter__(self):
+        read = self.file.read
+        while True:
+            n = shift = 0
+            while True:
+                b = read(1)
+                if not b:
+                    if shift:
+                        raise MemoFormatError("Truncated memo stream")
+                    return
+                b = ord(b)
+                n |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            data = read(n)
+            if len(data) < n:
+                raise MemoFormatError("Truncated memo stream")
+            yield self.memo_class.from_bytes(data)
@@ -25,6 +25,9 @@ class Reader(Worker):
     def handle_query(self, *args, **kwargs):
         if 'limit' not in kwargs:
             raise TypeError('Remote queries require a limit')
+        if kwargs.get('view'):
+            # views hold no state of their own to pickle
+            raise TypeError('Remote queries can not return record views')
         return list(self.db.query(*args, **kwargs))
 
 if __name__ == '__main__':
@@ -23,7 +23,7 @@ class Search(object):
     def __init__(self, db, query='', 
                  language=None, limit=None,
                  order=None, reverse=False,
-                 disimilate=False, distance=28):
+                 disimilate=False, distance=28, fields=None):
         if not isinstance(query, Query):
             query = db.querify(query)
         self.query = query
@@ -35,6 +35,7 @@ class Search(object):
         self._reverse = reverse
         self._disimilate = disimilate
         self._distance = distance
+        self._fields = fields
 
     def copy(self, **kwargs):
         args = dict(query=self.query,
@@ -43,7 +44,8 @@ class Search(object):
                     order=self._order,
                     reverse=self._reverse,
                     disimilate=self._disimilate,
-                    distance=self._distance)
+                    distance=self._distance,
+                    fields=self._fields)
         if kwargs:
             args.update(kwargs)
         return type(self)(self._db, **args)
@@ -101,6 +103,11 @@ class Search(object):
     def distance(self, distance):
         return self.copy(distance=distance)
 
+    def fields(self, *fields):
+        """Project the records onto dictionaries of *fields*, see
+        `Database.query`."""
+        return self.copy(fields=fields or None)
+
     def count(self):
         return self._db.count(self.query, language=self._language)
 
@@ -112,6 +119,16 @@ class Search(object):
             self.query, language=self._language,
             prefix=prefix, limit=limit, mlimit=mlimit))
 
+    def page(self, cursor=None):
+        """Return a page of records and a cursor for the next page,
+        see `Database.page`.  The search must be ordered.
+        """
+        kw = dict(cursor=cursor, reverse=self._reverse,
+                  language=self._language)
+        if self._limit:
+            kw['limit'] = self._limit
+        return self._db.page(self.query, self._order, **kw)
+
     @property
     def records(self):
         """Generator over xapian results.
@@ -120,7 +137,8 @@ class Search(object):
             self.query, limit=self._limit, language=self._language,
             order=self._order, reverse=self._reverse,
             disimilate=self._disimilate, 
-            disimilate_threshold=self._distance):
+            disimilate_threshold=self._distance,
+            fields=self._fields):
             yield r
 
     @property
@@ -130,6 +148,7 @@ class Search(object):
         return imap(attrgetter('uid'), self.records)
 
     def select(self, *attrs):
-        """ Generate out attr dicts from the records. """
-        for r in self.records:
-            yield {k: getattr(r, k, None) for k in attrs}
+        """ Generate out attr dicts from the records.  Attrs are read
+        from value slots only where they decode to exactly the stored
+        value, others, like locations, come from the records' data. """
+        return self.copy(fields=attrs).records
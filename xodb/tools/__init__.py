@@ -32,13 +32,18 @@ class LRUDict(OrderedDict):
         super(LRUDict, self).__init__(items)
 
     def __setitem__(self, key, value):
-        if len(self) >= self.limit:
-            self.popitem()
+        if key in self:
+            OrderedDict.__delitem__(self, key)
+        elif len(self) >= self.limit:
+            OrderedDict.__delitem__(self, next(iter(self)))
         super(LRUDict, self).__setitem__(key, value)
 
     def __getitem__(self, key):
-        item = dict.pop(self, key)
-        self[key] = item
+        # unlink and relink so the item moves to the end without
+        # leaving a stale link behind in the ordering
+        item = OrderedDict.__getitem__(self, key)
+        OrderedDict.__delitem__(self, key)
+        OrderedDict.__setitem__(self, key, item)
         return item
 
     def get(self, key, default=None):